@@ -1,22 +1,49 @@
+# Installed before the other imports so that they are measured with --profile-startup
+import startup_profile
+startup_profile.install_if_requested()
+
+import asyncio
+import hashlib
 import logging
+import multiprocessing
 import os
+import shutil
+import signal
+import threading
+import time
+import zlib
+from queue import Queue
 
 import music_tag
 from orator import Model
 from telegram.error import TelegramError
 from telegram.ext import Updater, CallbackContext, CommandHandler, MessageHandler, Filters, \
-     Defaults, PicklePersistence
-from telegram import Update, ReplyKeyboardMarkup, ChatAction, ParseMode, ReplyKeyboardRemove
+     Defaults, TypeHandler, Dispatcher, ExtBot, JobQueue
+from telegram import Update, ReplyKeyboardMarkup, ChatAction, ParseMode, ReplyKeyboardRemove, Message
 from telegram import ( 
     ReplyKeyboardMarkup, 
 )
 
 import localization as lp
-from utils import translate_key_to, reset_user_data_context, generate_start_over_keyboard, \
-create_user_directory, download_file, increment_usage_counter_for_user, delete_file, \
+from utils import translate_key_to, reset_user_data_context, reset_user_session, generate_start_over_keyboard, \
+create_user_directory, download_file, download_file_to, download_path, delete_file, \
 generate_module_selector_keyboard, generate_module_selector_video_keyboard, generate_tag_editor_keyboard, \
 generate_music_info, generate_tag_editor_video_keyboard, generate_module_selector_voice_keyboard, save_tags_to_file, \
-ffmpegcommand, myffmpegcommand, video_to_gif
+ffmpegcommand, myffmpegcommand, video_to_gif, video_to_animation, video_to_video_note, stream_voice_to_mp3, VOICE_TO_MP3_PARAMS
+from utils import metrics, tracing
+from utils.aio import AsyncRuntime
+from utils.animation import ANIMATION_PARAMS
+from utils.cache import TranscodeCache
+from utils.encoders import check_encoders, set_threads_per_job, thread_budget
+from utils.gif import choose_gif_preset
+from utils.persistence import ShardedSQLitePersistence
+from utils.scheduler import UserScheduler, SchedulerFull
+from utils.sent_files import find_sent_file_id, remember_sent_file_id, forget_sent_file_id
+from utils.transcoder import TranscodeExecutor, TranscodeQueueFull
+from utils.transport import SplitRequest
+from utils.video_note import VIDEO_NOTE_PARAMS
+from utils.usage_counter import UsageCounter
+from utils.user_cache import UserCache
 
 from models.user import User
 from dbConfig import db
@@ -26,15 +53,94 @@ Model.set_connection_resolver(db)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
 
+BOT_MODE = os.getenv("BOT_MODE") or 'polling'
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN") or '127.0.0.1'
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 8443)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or ''
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or 'telegram'
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or ''
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS") or 40)
+RECORD_UPDATES_PATH = os.getenv("RECORD_UPDATES_PATH") or ''
+
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS") or os.cpu_count() or 1)
+TRANSCODE_MAX_IN_FLIGHT = int(os.getenv("TRANSCODE_MAX_IN_FLIGHT") or 200)
+TRANSCODE_IO_THREADS = int(os.getenv("TRANSCODE_IO_THREADS") or 32)
+TRANSCODE_QUEUE_SIZE = int(os.getenv("TRANSCODE_QUEUE_SIZE") or 100)
+TRANSCODE_JOBS_PER_USER = int(os.getenv("TRANSCODE_JOBS_PER_USER") or 2)
+VOICE_STREAMING = os.getenv("VOICE_STREAMING", "").lower() in ('1', 'true', 'yes')
+TRANSCODE_CACHE_DIR = os.getenv("TRANSCODE_CACHE_DIR") or 'cache'
+TRANSCODE_CACHE_MAX_BYTES = int(os.getenv("TRANSCODE_CACHE_MAX_BYTES") or 2 * 1024 ** 3)
+# The GIF preset is picked so the GIF is expected to stay under this size
+GIF_MAX_BYTES = int(os.getenv("GIF_MAX_BYTES") or 10 * 1024 ** 2)
+# "mp4" sends the converted videos as muted MP4 animations, "gif" as real GIFs
+ANIMATION_FORMAT = (os.getenv("ANIMATION_FORMAT") or 'mp4').lower()
+PERSISTENCE_DIR = os.getenv("PERSISTENCE_DIR") or 'persistence_storage.d'
+PERSISTENCE_SHARDS = int(os.getenv("PERSISTENCE_SHARDS") or 16)
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT") or 3600)
+SESSION_EVICTION_INTERVAL = float(os.getenv("SESSION_EVICTION_INTERVAL") or 300)
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS") or 1)
+# The threads of an ffmpeg process, by default the cores shared out between all the ffmpeg
+# processes the worker processes may run at once
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS") or thread_budget(TRANSCODE_WORKERS * PROCESS_WORKERS))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS") or 16)
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE") or 1000)
+UPDATE_QUEUE_SIZE_PER_USER = int(os.getenv("UPDATE_QUEUE_SIZE_PER_USER") or 10)
+# Every update worker may be calling the API at once, plus the polling and the job queue threads
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE") or UPDATE_WORKERS + 4)
+BOT_API_TRANSFER_POOL_SIZE = int(os.getenv("BOT_API_TRANSFER_POOL_SIZE") or UPDATE_WORKERS + TRANSCODE_IO_THREADS)
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT") or 5)
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT") or 20)
+BOT_API_TRANSFER_TIMEOUT = float(os.getenv("BOT_API_TRANSFER_TIMEOUT") or 120)
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH") or ''
+METRICS_LISTEN = os.getenv("METRICS_LISTEN") or '127.0.0.1'
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL") or 300)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE") or 10000)
+USER_CACHE_FLUSH_INTERVAL = float(os.getenv("USER_CACHE_FLUSH_INTERVAL") or 5)
+USAGE_COUNTER_FLUSH_INTERVAL = float(os.getenv("USAGE_COUNTER_FLUSH_INTERVAL") or 10)
+USAGE_COUNTER_FLUSH_THRESHOLD = int(os.getenv("USAGE_COUNTER_FLUSH_THRESHOLD") or 1000)
+
 logger = logging.getLogger()
 
+tracing.configure(TRACE_EXPORT_PATH)
+
+scheduler = UserScheduler(
+    workers=UPDATE_WORKERS,
+    max_pending=UPDATE_QUEUE_SIZE,
+    max_pending_per_user=UPDATE_QUEUE_SIZE_PER_USER
+)
+runtime = AsyncRuntime(ffmpeg_processes=TRANSCODE_WORKERS, io_threads=TRANSCODE_IO_THREADS)
+set_threads_per_job(FFMPEG_THREADS)
+transcoder = TranscodeExecutor(
+    runtime,
+    max_in_flight=TRANSCODE_MAX_IN_FLIGHT,
+    max_queue_depth=TRANSCODE_QUEUE_SIZE,
+    max_jobs_per_user=TRANSCODE_JOBS_PER_USER
+)
+with startup_profile.phase('transcode cache index'):
+    transcode_cache = TranscodeCache(TRANSCODE_CACHE_DIR, TRANSCODE_CACHE_MAX_BYTES)
+usage_counter = UsageCounter(
+    flush_interval=USAGE_COUNTER_FLUSH_INTERVAL,
+    flush_threshold=USAGE_COUNTER_FLUSH_THRESHOLD
+)
+user_cache = UserCache(
+    ttl=USER_CACHE_TTL,
+    max_size=USER_CACHE_SIZE,
+    flush_interval=USER_CACHE_FLUSH_INTERVAL,
+    usage_counter=usage_counter
+)
+
+metrics.Gauge('bot_scheduler_pending_updates', 'Updates waiting for their turn', scheduler.pending)
+metrics.Gauge('bot_transcode_queue_depth', 'Conversions waiting to be started', transcoder.queue_depth)
+metrics.Gauge('bot_transcode_running', 'Conversions in progress', transcoder.running)
+
 def command_start(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     username = update.effective_user.username
 
     reset_user_data_context(context)
 
-    user = User.where('user_id', '=', user_id).first()
+    user = user_cache.get(user_id)
 
     update.message.reply_text(
         translate_key_to(lp.START_MESSAGE, context.user_data['language']),
@@ -49,7 +155,9 @@ def command_start(update: Update, context: CallbackContext) -> None:
         new_user.username = username
         new_user.number_of_files_sent = 0
 
-        new_user.save()
+        with metrics.phase('db'):
+            new_user.save()
+        user_cache.add(user_id, {'username': username, 'language': 'en', 'number_of_files_sent': 0})
 
         logger.info("A user with id %s has been started to use the bot.", user_id)
 
@@ -99,9 +207,7 @@ def set_language(update: Update, context: CallbackContext) -> None:
         reply_markup=ReplyKeyboardRemove()
     )
 
-    user = User.where('user_id', '=', user_id).first()
-    user.language = user_data['language']
-    user.push()
+    user_cache.update(user_id, language=user_data['language'])
 
 def handle_voice_message(update: Update, context: CallbackContext) -> None:
     message = update.message
@@ -133,39 +239,18 @@ def handle_voice_message(update: Update, context: CallbackContext) -> None:
         logger.error("Couldn't create directory for user %s", user_id, exc_info=True)
         return
 
-    try:
-        file_download_path = download_file(
-            user_id=user_id,
-            file_to_download=message.voice,
-            file_type='voice',
-            context=context
-        )
-    except ValueError:
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, language),
-            reply_markup=generate_start_over_keyboard(language)
-        )
-        logger.error("Error on downloading %s's file. File type: Audio", user_id, exc_info=True)
-        return
-
-    try:
-        music = music_tag.load_file(file_download_path)
-    except (OSError, NotImplementedError):
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_READING_TAGS, language),
-            reply_markup=generate_start_over_keyboard(language)
-        )
-        logger.error(
-            "Error on reading the tags %s's file. File path: %s",
-            user_id,
-            file_download_path,
-            exc_info=True
-        )
-        return
+    # The voice is only downloaded by the conversion, once neither the transcode cache nor the
+    # sent files have its result. In streaming mode it is piped straight from Telegram into
+    # ffmpeg and never saved at all.
+    file_download_path = ''
+    if not VOICE_STREAMING:
+        file_download_path = download_path(user_id, message.voice, 'voice')
 
     reset_user_data_context(context)
 
     user_data['voice_path'] = file_download_path
+    user_data['voice_unique_id'] = message.voice.file_unique_id
+    user_data['voice_file_id'] = message.voice.file_id
     user_data['art_path'] = ''
     user_data['voice_message_id'] = message.message_id
     user_data['voice_duration'] = message.voice.duration
@@ -196,11 +281,8 @@ def handle_voice_message(update: Update, context: CallbackContext) -> None:
 
     show_module_selector_voice(update, context)
 
-    increment_usage_counter_for_user(user_id=user_id)
-
-    user = User.where('user_id', '=', user_id).first()
-    user.username = update.effective_user.username
-    user.push()
+    user_cache.increment_files_sent(user_id)
+    user_cache.update(user_id, username=update.effective_user.username)
 
     delete_file(old_voice_path)
     delete_file(old_art_path)
@@ -253,7 +335,8 @@ def handle_music_message(update: Update, context: CallbackContext) -> None:
         return
 
     try:
-        music = music_tag.load_file(file_download_path)
+        with metrics.phase('tag_read'), tracing.span('tag_read'):
+            music = music_tag.load_file(file_download_path)
     except (OSError, NotImplementedError):
         message.reply_text(
             translate_key_to(lp.ERR_ON_READING_TAGS, language),
@@ -270,6 +353,7 @@ def handle_music_message(update: Update, context: CallbackContext) -> None:
     reset_user_data_context(context)
 
     user_data['music_path'] = file_download_path
+    user_data['music_unique_id'] = message.audio.file_unique_id
     user_data['art_path'] = ''
     user_data['music_message_id'] = message.message_id
     user_data['music_duration'] = message.audio.duration
@@ -300,11 +384,8 @@ def handle_music_message(update: Update, context: CallbackContext) -> None:
 
     show_module_selector(update, context)
 
-    increment_usage_counter_for_user(user_id=user_id)
-
-    user = User.where('user_id', '=', user_id).first()
-    user.username = update.effective_user.username
-    user.push()
+    user_cache.increment_files_sent(user_id)
+    user_cache.update(user_id, username=update.effective_user.username)
 
     delete_file(old_music_path)
     delete_file(old_art_path)
@@ -382,20 +463,9 @@ def handle_video_message(update: Update, context: CallbackContext) -> None:
         logger.error("Couldn't create directory for user %s", user_id, exc_info=True)
         return
 
-    try:
-        file_download_path = download_file(
-            user_id=user_id,
-            file_to_download=message.video,
-            file_type='video',
-            context=context
-        )
-    except ValueError:
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_DOWNLOAD_VIDEO_MESSAGE, language),
-            reply_markup=generate_start_over_keyboard(language)
-        )
-        logger.error("Error on downloading %s's file. File type: Video", user_id, exc_info=True)
-        return
+    # Only downloaded by the conversion, once neither the transcode cache nor the sent files
+    # have its result
+    file_download_path = download_path(user_id, message.video, 'video')
 
     try:
         video = file_download_path
@@ -415,9 +485,13 @@ def handle_video_message(update: Update, context: CallbackContext) -> None:
     reset_user_data_context(context)
 
     user_data['video_path'] = file_download_path
+    user_data['video_unique_id'] = message.video.file_unique_id
+    user_data['video_file_id'] = message.video.file_id
     # user_data['video_art_path'] = ''
     user_data['video_message_id'] = message.message_id
     user_data['video_duration'] = message.video.duration
+    user_data['video_width'] = message.video.width
+    user_data['video_height'] = message.video.height
 
     # tag_editor_context = user_data['tag_editor']
 
@@ -446,11 +520,8 @@ def handle_video_message(update: Update, context: CallbackContext) -> None:
     # show_module_selector(update, context)
     show_module_selector_video(update, context)
 
-    increment_usage_counter_for_user(user_id=user_id)
-
-    user = User.where('user_id', '=', user_id).first()
-    user.username = update.effective_user.username
-    user.push()
+    user_cache.increment_files_sent(user_id)
+    user_cache.update(user_id, username=update.effective_user.username)
 
     delete_file(old_video_path)
     # delete_file(old_video_art_path)
@@ -662,7 +733,7 @@ def handle_convert_voice_message(update: Update, context: CallbackContext) -> No
 
     tag_editor_keyboard = generate_module_selector_voice_keyboard(lang)
 
-    if voice_path:
+    if voice_path or user_data['voice_file_id']:
         # with open(video_path, 'rb') as video_file:
         #     message.reply_video_note(
         #         video_note=video_file,
@@ -748,162 +819,400 @@ def prepare_for_album_art(update: Update, context: CallbackContext) -> None:
 
     update.message.reply_text(message_text)
 
-def finish_convert_voice_to_audio(update: Update, context: CallbackContext) -> None:
-    message = update.message
-    user_data = context.user_data
+def keeping_output(convert, files: list):
+    """Wrap a conversion so the path of the file it writes is added to `files`"""
+    async def run() -> str:
+        output_path = await convert()
+        files.append(output_path)
 
-    context.bot.send_chat_action(
-        chat_id=update.message.chat_id,
-        action=ChatAction.UPLOAD_AUDIO
-    )
+        return output_path
 
-    voice_path = user_data['voice_path']
+    return run
 
-    myffmpegcommand(voice_path, user_data)
+def after_download(convert, context: CallbackContext, file_path: str, file_id: str, file_type: str):
+    """Wrap a conversion so the source file the user sent is downloaded right before it, unless
+    it is on the disk already"""
+    async def run() -> str:
+        if not os.path.exists(file_path):
+            await asyncio.to_thread(download_file_to, file_path, file_id, file_type, context)
 
-    lang = user_data['language']
-    # voice_file = open(voice_path, 'rb').read()
+        return await convert()
 
-    new_voice_path = user_data['new_voice_art_path']
-    # logging.error(new_voice_path)
+    return run
 
-    # voice_path = voice_path.split("/")[-1]
+def submit_transcode_job(update: Update, context: CallbackContext, job, on_done, source_key: str,
+                         files: list) -> None:
+    """Hand a conversion over to the transcoder so the dispatcher thread is free for other
+    users. `on_done` is called with the result of `job` by the scheduler, in turn with the other
+    updates of the user.
 
-    # mime_type = voice_path.split(".")[-1]
-    # voice = voice_path.split(".")[0]
+    The user may have started over by then, so only `files` are deleted once the job is done:
+    the source file first, then what `job` adds to it. The session is reset only if its
+    `source_key` still holds the message the job was started for. The source path can't tell
+    the sessions apart, as it is empty whenever the voice is streamed.
+    """
+    message = update.message
+    user_id = update.effective_user.id
+    lang = context.user_data['language']
+    start_over_button_keyboard = generate_start_over_keyboard(lang)
+    source_message_id = context.user_data.get(source_key)
 
-    # # logger.error(voice_path)
-    # n_voice = ffmpegcommand(voice, mime_type)
+    def clean_up() -> None:
+        for file_path in files:
+            if file_path:
+                delete_file(file_path)
+        if source_message_id and context.user_data.get(source_key) == source_message_id:
+            reset_user_data_context(context)
 
-    # logger.error(n_voice)
+    def finish(result) -> None:
+        try:
+            on_done(result)
+        finally:
+            clean_up()
 
-    start_over_button_keyboard = generate_start_over_keyboard(lang)
+    def report_error(_error: BaseException) -> None:
+        try:
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_CONVERTING, lang),
+                reply_markup=start_over_button_keyboard
+            )
+        finally:
+            clean_up()
+
+    # The job and the callbacks run on other threads, so they are tied to the trace explicitly
+    parent_span = tracing.current_span()
+
+    async def traced_job():
+        with tracing.span('transcode', parent=parent_span):
+            if asyncio.iscoroutinefunction(job):
+                return await job()
+            return await asyncio.to_thread(job)
+
+    def traced(callback):
+        def run(result) -> None:
+            with tracing.span('deliver', parent=parent_span):
+                callback(result)
+
+        return run
+
+    # The callbacks touch `user_data`, so they wait for their turn behind the other updates of
+    # the user instead of running right away on the thread that finished the job
+    def in_turn(callback):
+        def schedule(result) -> None:
+            scheduler.submit(
+                user_id,
+                lambda: run_and_persist(traced(callback), update, context, result),
+                limit=False
+            )
 
-    # try:
-    #     save_tags_to_file(
-    #         file=music_path,
-    #         tags=music_tags,
-    #         new_art_path=new_art_path
-    #     )
-    # except (OSError, BaseException):
-    #     message.reply_text(
-    #         translate_key_to(lp.ERR_ON_UPDATING_TAGS, lang),
-    #         reply_markup=start_over_button_keyboard
-    #     )
-    #     logger.error("Error on updating tags for file %s's file.", music_path, exc_info=True)
-    #     return
+        return schedule
 
     try:
-        with open(new_voice_path, 'rb') as voice:
-            # ffmpegcommand(voice_file, output)
-            message.reply_voice(
-                voice=voice,
-                reply_to_message_id=update.effective_message.message_id,
-                reply_markup=start_over_button_keyboard,
-            )
-        # with open(music_path, 'rb') as music_file:
-
-        #     context.bot.send_audio(
-        #         audio=music_file,
-        #         duration=user_data['music_duration'],
-        #         chat_id=update.message.chat_id,
-        #         caption=f"🆔 {BOT_USERNAME}",
-        #         thumb=thumb,
-        #         reply_markup=start_over_button_keyboard,
-        #         reply_to_message_id=user_data['music_message_id']
-        #     )
-    except (TelegramError, BaseException) as error:
+        transcoder.submit(user_id, traced_job, on_done=in_turn(finish), on_error=in_turn(report_error))
+    except TranscodeQueueFull:
         message.reply_text(
-            translate_key_to(lp.ERR_ON_UPLOADING, lang),
+            translate_key_to(lp.ERR_TOO_MANY_REQUESTS, lang),
             reply_markup=start_over_button_keyboard
         )
-        logger.exception("Telegram error: %s", error)
+        logger.warning("Transcode queue is full, rejected a job of user %s", user_id)
+
+def instrumented(callback):
+    """Wrap a handler callback to record how long it takes, and to trace it as a part of the
+    request of the user: a new file starts a new trace, which the following updates (e.g. the
+    `/vadone` that converts it) continue until the session is reset.
+    """
+    def run(update: Update, context: CallbackContext) -> None:
+        with metrics.handler_duration.time(handler=callback.__name__):
+            if not tracing.enabled():
+                callback(update, context)
+                return
+
+            media_type = media_type_of(update)
+            user_data = context.user_data
+            if media_type in ('voice', 'audio', 'video') or not user_data['trace_id']:
+                user_data['trace_id'] = tracing.new_trace_id()
+
+            with tracing.span(callback.__name__, trace_id=user_data['trace_id'],
+                              media_type=media_type, **attachment_attributes(update)):
+                callback(update, context)
+
+    return run
+
+def attachment_attributes(update: Update) -> dict:
+    attachment = update.effective_message.effective_attachment if update.effective_message else None
+    attributes = {}
+    for name in ('file_size', 'duration', 'mime_type', 'width', 'height'):
+        value = getattr(attachment, name, None)
+        if value is not None:
+            attributes[name] = value
+
+    return attributes
+
+def media_type_of(update: Update) -> str:
+    message = update.effective_message
+    if message is None:
+        return 'other'
+    for media_type in ('voice', 'audio', 'video', 'photo'):
+        if getattr(message, media_type):
+            return media_type
+    if message.text and message.text.startswith('/'):
+        return 'command'
+
+    return 'text' if message.text else 'other'
+
+def count_update(update: Update, _context: CallbackContext) -> None:
+    metrics.updates_total.inc(media_type=media_type_of(update))
+
+def run_and_persist(callback, update: Update, context: CallbackContext, *args) -> None:
+    """Run `callback` and save the `user_data` it may have changed. The dispatcher only saves it
+    right after a handler returns, which is before a scheduled handler has actually run.
+    """
+    try:
+        callback(*args)
+    except Exception as error:
+        context.dispatcher.dispatch_error(update, error)
+    finally:
+        context.dispatcher.update_persistence(update)
+
+def in_user_order(callback):
+    """Wrap a handler callback so it runs on the scheduler: in order with the other updates of
+    the same user, and in parallel with the updates of other users.
+    """
+    def schedule(update: Update, context: CallbackContext) -> None:
+        user = update.effective_user
+        if user is None:
+            callback(update, context)
+            return
+
+        queued_at = time.perf_counter()
+
+        def run() -> None:
+            metrics.queue_wait.observe(time.perf_counter() - queued_at)
+            run_and_persist(callback, update, context, update, context)
+
+        try:
+            scheduler.submit(user.id, run)
+        except SchedulerFull:
+            logger.warning("Too many pending updates, dropped an update of user %s", user.id)
+            if update.effective_message:
+                update.effective_message.reply_text(
+                    translate_key_to(lp.ERR_TOO_MANY_REQUESTS, context.user_data['language'])
+                )
+
+    return schedule
+
+def send_previously_sent_file(context: CallbackContext, source_unique_id: str, operation: str,
+                              params: dict, send) -> bool:
+    """Answer with a result that has already been uploaded once, by its Telegram `file_id`,
+    so nothing has to be converted or uploaded again.
+
+    **Keyword arguments:**
+     - context (CallbackContext) -- The context object of the user
+     - source_unique_id (str) -- The `file_unique_id` of the file the user sent
+     - operation (str) -- The name of the operation, e.g. 'voice_to_mp3'
+     - params (dict) -- The parameters of the operation
+     - send (callable) -- A function that sends the given `file_id` to the user
+
+    **Returns:**
+     Whether the result has been sent
+    """
+    file_id = find_sent_file_id(source_unique_id, operation, params)
+
+    if not file_id:
+        return False
+
+    try:
+        send(file_id)
+    except TelegramError:
+        logger.warning("Couldn't resend file_id %s, converting again", file_id, exc_info=True)
+        forget_sent_file_id(source_unique_id, operation, params)
+        return False
 
     reset_user_data_context(context)
 
-def finish_convert_video(update: Update, context: CallbackContext) -> None:
+    return True
+
+def remember_upload(source_unique_id: str, operation: str, params: dict, sent_message: Message) -> None:
+    """Remember the `file_id` of an uploaded result. The user has the file already, so a
+    failure is only logged."""
+    try:
+        remember_sent_file_id(source_unique_id, operation, params, sent_message.effective_attachment.file_id)
+    except BaseException:
+        logger.error("Couldn't remember the file_id of the %s of %s", operation, source_unique_id, exc_info=True)
+
+def finish_convert_voice_to_audio(update: Update, context: CallbackContext) -> None:
     message = update.message
     user_data = context.user_data
 
     context.bot.send_chat_action(
         chat_id=update.message.chat_id,
-        action=ChatAction.UPLOAD_VIDEO
+        action=ChatAction.UPLOAD_AUDIO
     )
 
-    video_path = user_data['video_path']
-
+    voice_path = user_data['voice_path']
+    voice_unique_id = user_data['voice_unique_id']
+    voice_file_id = user_data['voice_file_id']
     lang = user_data['language']
-    video_file = open(video_path, 'rb').read()
 
     start_over_button_keyboard = generate_start_over_keyboard(lang)
 
-    # try:
-    #     save_tags_to_file(
-    #         file=music_path,
-    #         tags=music_tags,
-    #         new_art_path=new_art_path
-    #     )
-    # except (OSError, BaseException):
-    #     message.reply_text(
-    #         translate_key_to(lp.ERR_ON_UPDATING_TAGS, lang),
-    #         reply_markup=start_over_button_keyboard
-    #     )
-    #     logger.error("Error on updating tags for file %s's file.", music_path, exc_info=True)
-    #     return
-    covert_video_to_gif = user_data['convert_video_to_gif']
-    if covert_video_to_gif == True:
-        video_to_gif(video_path, user_data)
+    def reply_voice(voice, **kwargs) -> Message:
+        return message.reply_voice(
+            voice=voice,
+            reply_to_message_id=update.effective_message.message_id,
+            reply_markup=start_over_button_keyboard,
+            **kwargs
+        )
+
+    if send_previously_sent_file(context, voice_unique_id, 'voice_to_mp3', VOICE_TO_MP3_PARAMS, reply_voice):
+        return
+
+    def send_voice(new_voice) -> None:
         try:
-            with open(video_path, 'rb') as video_file:
-                message.reply_video(
-                    video=video_file,
-                    reply_to_message_id=update.effective_message.message_id,
-                    reply_markup=start_over_button_keyboard,
-                )
-            # with open(music_path, 'rb') as music_file:
-
-            #     context.bot.send_audio(
-            #         audio=music_file,
-            #         duration=user_data['music_duration'],
-            #         chat_id=update.message.chat_id,
-            #         caption=f"🆔 {BOT_USERNAME}",
-            #         thumb=thumb,
-            #         reply_markup=start_over_button_keyboard,
-            #         reply_to_message_id=user_data['music_message_id']
-            #     )
+            if isinstance(new_voice, bytes):
+                sent_message = reply_voice(new_voice, filename='voice.mp3')
+            else:
+                with open(new_voice, 'rb') as voice:
+                    sent_message = reply_voice(voice)
         except (TelegramError, BaseException) as error:
             message.reply_text(
                 translate_key_to(lp.ERR_ON_UPLOADING, lang),
                 reply_markup=start_over_button_keyboard
             )
             logger.exception("Telegram error: %s", error)
+        else:
+            remember_upload(voice_unique_id, 'voice_to_mp3', VOICE_TO_MP3_PARAMS, sent_message)
+
+    files = [voice_path]
+
+    async def convert_voice():
+        if VOICE_STREAMING:
+            cached_path = await asyncio.to_thread(transcode_cache.get, voice_unique_id, VOICE_TO_MP3_PARAMS)
+            if cached_path:
+                return cached_path
+            voice_file = await asyncio.to_thread(context.bot.get_file, voice_file_id)
+            mp3 = await stream_voice_to_mp3(voice_file)
+            try:
+                await asyncio.to_thread(transcode_cache.put_content, voice_unique_id, VOICE_TO_MP3_PARAMS, mp3,
+                                        f".{VOICE_TO_MP3_PARAMS['format']}")
+            except OSError:
+                logger.error("Couldn't cache the converted voice of %s", voice_unique_id, exc_info=True)
+            return mp3
+
+        return await transcode_cache.get_or_create(
+            voice_unique_id,
+            VOICE_TO_MP3_PARAMS,
+            keeping_output(after_download(
+                lambda: myffmpegcommand(voice_path, voice_unique_id), context, voice_path, voice_file_id, 'voice'
+            ), files)
+        )
+
+    submit_transcode_job(update, context, job=convert_voice, on_done=send_voice, source_key='voice_message_id',
+                         files=files)
+
+def finish_convert_video(update: Update, context: CallbackContext) -> None:
+    message = update.message
+    user_data = context.user_data
+
+    context.bot.send_chat_action(
+        chat_id=update.message.chat_id,
+        action=ChatAction.UPLOAD_VIDEO
+    )
+
+    video_path = user_data['video_path']
+    video_unique_id = user_data['video_unique_id']
+    video_file_id = user_data['video_file_id']
+    lang = user_data['language']
+
+    start_over_button_keyboard = generate_start_over_keyboard(lang)
+
+    covert_video_to_gif = user_data['convert_video_to_gif']
+    if covert_video_to_gif == True:
+        def reply_animation(animation) -> Message:
+            return message.reply_animation(
+                animation=animation,
+                reply_to_message_id=update.effective_message.message_id,
+                reply_markup=start_over_button_keyboard,
+            )
+
+        if ANIMATION_FORMAT == 'gif':
+            operation, convert = 'video_to_gif', video_to_gif
+            params = choose_gif_preset(
+                user_data['video_duration'] or 0,
+                user_data['video_width'],
+                user_data['video_height'],
+                GIF_MAX_BYTES
+            )
+        else:
+            operation, convert, params = 'video_to_animation', video_to_animation, ANIMATION_PARAMS
+
+        if send_previously_sent_file(context, video_unique_id, operation, params, reply_animation):
+            return
+
+        def send_animation(animation_path: str) -> None:
+            try:
+                with open(animation_path, 'rb') as animation_file:
+                    sent_message = reply_animation(animation_file)
+            except (TelegramError, BaseException) as error:
+                message.reply_text(
+                    translate_key_to(lp.ERR_ON_UPLOADING, lang),
+                    reply_markup=start_over_button_keyboard
+                )
+                logger.exception("Telegram error: %s", error)
+            else:
+                remember_upload(video_unique_id, operation, params, sent_message)
+
+        files = [video_path]
+
+        async def convert_animation() -> str:
+            return await transcode_cache.get_or_create(
+                video_unique_id,
+                params,
+                keeping_output(after_download(
+                    lambda: convert(video_path, video_unique_id, params), context, video_path, video_file_id, 'video'
+                ), files)
+            )
+
+        submit_transcode_job(update, context, job=convert_animation, on_done=send_animation,
+                             source_key='video_message_id', files=files)
     else :
-        try:
-            with open(video_path, 'rb') as video_file:
-                message.reply_video_note(
-                    video_note=video_file,
-                    reply_to_message_id=update.effective_message.message_id,
-                    reply_markup=start_over_button_keyboard,
+        def reply_video_note(video_note) -> Message:
+            return message.reply_video_note(
+                video_note=video_note,
+                reply_to_message_id=update.effective_message.message_id,
+                reply_markup=start_over_button_keyboard,
+            )
+
+        if send_previously_sent_file(context, video_unique_id, 'video_to_video_note', VIDEO_NOTE_PARAMS,
+                                     reply_video_note):
+            return
+
+        def send_video_note(video_note_path: str) -> None:
+            try:
+                with open(video_note_path, 'rb') as video_note_file:
+                    sent_message = reply_video_note(video_note_file)
+            except (TelegramError, BaseException) as error:
+                message.reply_text(
+                    translate_key_to(lp.ERR_ON_UPLOADING, lang),
+                    reply_markup=start_over_button_keyboard
                 )
-            # with open(music_path, 'rb') as music_file:
-
-            #     context.bot.send_audio(
-            #         audio=music_file,
-            #         duration=user_data['music_duration'],
-            #         chat_id=update.message.chat_id,
-            #         caption=f"🆔 {BOT_USERNAME}",
-            #         thumb=thumb,
-            #         reply_markup=start_over_button_keyboard,
-            #         reply_to_message_id=user_data['music_message_id']
-            #     )
-        except (TelegramError, BaseException) as error:
-            message.reply_text(
-                translate_key_to(lp.ERR_ON_UPLOADING, lang),
-                reply_markup=start_over_button_keyboard
+                logger.exception("Telegram error: %s", error)
+            else:
+                remember_upload(video_unique_id, 'video_to_video_note', VIDEO_NOTE_PARAMS, sent_message)
+
+        files = [video_path]
+
+        async def convert_video_note() -> str:
+            return await transcode_cache.get_or_create(
+                video_unique_id,
+                VIDEO_NOTE_PARAMS,
+                keeping_output(after_download(
+                    lambda: video_to_video_note(video_path, video_unique_id), context, video_path, video_file_id, 'video'
+                ), files)
             )
-            logger.exception("Telegram error: %s", error)
 
-    reset_user_data_context(context)
+        submit_transcode_job(update, context, job=convert_video_note, on_done=send_video_note,
+                             source_key='video_message_id', files=files)
 
 def display_preview_video(update: Update, context: CallbackContext) -> None:
     pass
@@ -918,6 +1227,7 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
     )
 
     music_path = user_data['music_path']
+    music_unique_id = user_data['music_unique_id']
     new_art_path = user_data['new_art_path']
     music_tags = user_data['tag_editor']
     lang = user_data['language']
@@ -925,12 +1235,33 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
 
     start_over_button_keyboard = generate_start_over_keyboard(lang)
 
-    try:
-        save_tags_to_file(
-            file=music_path,
-            tags=music_tags,
-            new_art_path=new_art_path
+    tag_editor_params = {
+        tag: music_tags.get(tag, '')
+        for tag in ('artist', 'title', 'album', 'genre', 'year', 'disknumber', 'tracknumber')
+    }
+    tag_editor_params['art'] = hashlib.sha256(thumb).hexdigest()
+
+    def send_audio(audio, **kwargs) -> Message:
+        return context.bot.send_audio(
+            audio=audio,
+            duration=user_data['music_duration'],
+            chat_id=update.message.chat_id,
+            caption=f"🆔 {BOT_USERNAME}",
+            reply_markup=start_over_button_keyboard,
+            reply_to_message_id=user_data['music_message_id'],
+            **kwargs
         )
+
+    if send_previously_sent_file(context, music_unique_id, 'tag_editor', tag_editor_params, send_audio):
+        return
+
+    try:
+        with metrics.phase('tag_write'), tracing.span('tag_write'):
+            save_tags_to_file(
+                file=music_path,
+                tags=music_tags,
+                new_art_path=new_art_path
+            )
     except (OSError, BaseException):
         message.reply_text(
             translate_key_to(lp.ERR_ON_UPDATING_TAGS, lang),
@@ -941,21 +1272,15 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
 
     try:
         with open(music_path, 'rb') as music_file:
-            context.bot.send_audio(
-                audio=music_file,
-                duration=user_data['music_duration'],
-                chat_id=update.message.chat_id,
-                caption=f"🆔 {BOT_USERNAME}",
-                thumb=thumb,
-                reply_markup=start_over_button_keyboard,
-                reply_to_message_id=user_data['music_message_id']
-            )
+            sent_message = send_audio(music_file, thumb=thumb)
     except (TelegramError, BaseException) as error:
         message.reply_text(
             translate_key_to(lp.ERR_ON_UPLOADING, lang),
             reply_markup=start_over_button_keyboard
         )
         logger.exception("Telegram error: %s", error)
+    else:
+        remember_upload(music_unique_id, 'tag_editor', tag_editor_params, sent_message)
 
     reset_user_data_context(context)
 
@@ -984,12 +1309,72 @@ def display_preview(update: Update, context: CallbackContext) -> None:
             reply_to_message_id=update.effective_message.message_id,
         )
 
-def main():
-    defaults = Defaults(parse_mode=ParseMode.MARKDOWN, timeout=120)
-    persistence = PicklePersistence('persistence_storage')
+def evict_idle_sessions(context: CallbackContext) -> None:
+    """Offload the sessions of idle users to the persistence and remove their downloaded files.
+    The sessions are loaded back when the users send their next update.
+
+    The sessions are reset before they are saved, as they would point to the removed files.
+    """
+    def clean_up(user_id: int, user_data) -> None:
+        reset_user_session(user_data)
+        shutil.rmtree(f"downloads/{user_id}", ignore_errors=True)
+
+    evicted = context.dispatcher.persistence.evict_idle_users(
+        context.dispatcher.user_data,
+        SESSION_IDLE_TIMEOUT,
+        can_evict=lambda user_id: not transcoder.has_pending(user_id) and not scheduler.has_pending(user_id),
+        on_evict=clean_up
+    )
+
+    if evicted:
+        logger.info("Evicted %s idle sessions.", evicted)
+
+record_updates_lock = threading.Lock()
+
+def record_update(update: Update, _context: CallbackContext) -> None:
+    """Append every incoming update to `RECORD_UPDATES_PATH`, so it can be replayed against a
+    local webhook with `replay_updates.py`
+    """
+    with record_updates_lock:
+        with open(RECORD_UPDATES_PATH, 'a', encoding='utf-8') as record_file:
+            record_file.write(update.to_json() + "\n")
+
+class BotUpdater(Updater):
+    """The updater of the bot. Without a public `WEBHOOK_URL`, python-telegram-bot would register
+    https://<listen>:<port>/<path> as the webhook and fail before its server is up. The webhook
+    only serves local requests then, e.g. the ones of replay_updates.py, so it isn't registered.
+    """
+
+    def _bootstrap(self, *args, **kwargs) -> None:
+        if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+            return
+
+        super()._bootstrap(*args, **kwargs)
+
+def start_receiving_updates(updater: Updater) -> None:
+    if BOT_MODE == 'webhook':
+        # The webhook server of python-telegram-bot doesn't check the secret token header, so
+        # the secret is a part of the path instead and requests to any other path are rejected
+        url_path = '/'.join(part for part in (WEBHOOK_PATH.strip('/'), WEBHOOK_SECRET) if part)
+        if not WEBHOOK_URL:
+            logger.warning("WEBHOOK_URL is not set, the webhook isn't registered with Telegram")
+        updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}" if WEBHOOK_URL else None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        logger.info("Listening for webhook updates on %s:%s", WEBHOOK_LISTEN, WEBHOOK_PORT)
+    else:
+        updater.start_polling()
+
+def register_handlers(dispatcher: Dispatcher) -> None:
+    def add_handler(handler, group=0):
+        handler.callback = in_user_order(instrumented(handler.callback))
+        dispatcher.add_handler(handler, group)
     ##########
-    updater = Updater(BOT_TOKEN, persistence=persistence, defaults=defaults)
-    add_handler = updater.dispatcher.add_handler
+    dispatcher.add_handler(TypeHandler(Update, count_update), group=-2)
     ##########
     add_handler(CommandHandler('start', command_start))
     add_handler(CommandHandler('new', start_over))
@@ -1045,8 +1430,169 @@ def main():
     add_handler(MessageHandler(Filters.regex('^(🇬🇧 English)$'), set_language))
     add_handler(MessageHandler(Filters.regex('^(🇮🇷 فارسی)$'), set_language))
     ##########
-    updater.start_polling()
+    dispatcher.job_queue.run_repeating(evict_idle_sessions, interval=SESSION_EVICTION_INTERVAL)
+
+def start_metrics(port: int) -> None:
+    """Serve the metrics on `port`, if it is set, and count the logged errors"""
+    if not port:
+        return
+
+    root_logger = logging.getLogger()
+    if not root_logger.handlers:
+        # Without any handler the warnings and errors go to stderr through `lastResort`, which
+        # stops happening as soon as the error counter is added
+        root_logger.addHandler(logging.lastResort)
+    root_logger.addHandler(metrics.ErrorCounter())
+    metrics.MetricsServer(METRICS_LISTEN, port).start()
+
+def start_services() -> None:
+    check_encoders()
+    scheduler.start()
+    transcoder.start()
+    user_cache.start()
+    usage_counter.start()
+
+def stop_services() -> None:
+    transcoder.stop()
+    runtime.stop()
+    scheduler.stop()
+    user_cache.stop()
+    usage_counter.stop()
+
+def build_bot() -> ExtBot:
+    """Create the bot with separate connection pools for the small JSON calls and for the
+    uploads and downloads, so a reply never waits behind somebody's 50 MB upload.
+    """
+    request = SplitRequest(
+        con_pool_size=BOT_API_POOL_SIZE,
+        transfer_pool_size=BOT_API_TRANSFER_POOL_SIZE,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        read_timeout=BOT_API_READ_TIMEOUT,
+        transfer_read_timeout=BOT_API_TRANSFER_TIMEOUT
+    )
+
+    return ExtBot(BOT_TOKEN, defaults=Defaults(parse_mode=ParseMode.MARKDOWN), request=request)
+
+def worker_for(user_id: int, workers: int) -> int:
+    """The index of the worker process that handles the updates of a user"""
+    return zlib.crc32(str(user_id).encode()) % workers
+
+def run_worker(index: int, updates) -> None:
+    """The entry point of a worker process. It runs the handlers for the updates the supervisor
+    routes to it, which are always the updates of the same users, so their `user_data`, the
+    user cache and `downloads/<user_id>/` stay local to this process.
+    """
+    global transcode_cache
+
+    # The supervisor decides when the workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    transcode_cache = TranscodeCache(
+        os.path.join(TRANSCODE_CACHE_DIR, f"worker_{index}"),
+        TRANSCODE_CACHE_MAX_BYTES // PROCESS_WORKERS
+    )
+    bot = build_bot()
+    persistence = ShardedSQLitePersistence(PERSISTENCE_DIR, shards=PERSISTENCE_SHARDS)
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, Queue(), job_queue=job_queue, persistence=persistence)
+    job_queue.set_dispatcher(dispatcher)
+    register_handlers(dispatcher)
+
+    start_metrics(METRICS_PORT + index if METRICS_PORT else 0)
+    start_services()
+    job_queue.start()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name=f"dispatcher_{index}")
+    dispatcher_thread.start()
+    logger.info("Worker %s is ready.", index)
+
+    while True:
+        update = updates.get()
+        if update is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(update, bot))
+
+    dispatcher.stop()
+    dispatcher_thread.join()
+    job_queue.stop()
+    stop_services()
+    persistence.close()
+
+def run_supervisor(updater: Updater) -> None:
+    """Receive the updates and hand each of them to one of `PROCESS_WORKERS` worker processes,
+    picked by the id of the user who sent it.
+    """
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(PROCESS_WORKERS)]
+    workers = [None] * PROCESS_WORKERS
+    workers_lock = threading.Lock()
+
+    def start_worker(index: int) -> None:
+        workers[index] = context.Process(
+            target=run_worker,
+            args=(index, queues[index]),
+            name=f"worker_{index}"
+        )
+        workers[index].start()
+
+    def route_update(update: Update, _context: CallbackContext) -> None:
+        user = update.effective_user
+        index = worker_for(user.id if user else 0, PROCESS_WORKERS)
+
+        with workers_lock:
+            if not workers[index].is_alive():
+                logger.error("Worker %s has died with exit code %s, restarting it.",
+                             index, workers[index].exitcode)
+                start_worker(index)
+
+        queues[index].put(update.to_dict())
+
+    for index in range(PROCESS_WORKERS):
+        start_worker(index)
+
+    if RECORD_UPDATES_PATH:
+        updater.dispatcher.add_handler(TypeHandler(Update, record_update), group=-1)
+    updater.dispatcher.add_handler(TypeHandler(Update, route_update))
+
+    start_receiving_updates(updater)
+    updater.idle()
+
+    for updates in queues:
+        updates.put(None)
+    for worker in workers:
+        worker.join()
+
+def main():
+    if PROCESS_WORKERS > 1 and not startup_profile.enabled():
+        # The supervisor only routes updates; the handlers and the persistence live in the workers
+        run_supervisor(BotUpdater(BOT_TOKEN))
+        return
+
+    with startup_profile.phase('persistence'):
+        persistence = ShardedSQLitePersistence(PERSISTENCE_DIR, shards=PERSISTENCE_SHARDS)
+    ##########
+    with startup_profile.phase('bot and updater, loading the persisted data'):
+        updater = BotUpdater(bot=build_bot(), persistence=persistence)
+    with startup_profile.phase('handler registration'):
+        if RECORD_UPDATES_PATH:
+            updater.dispatcher.add_handler(TypeHandler(Update, record_update), group=-1)
+        register_handlers(updater.dispatcher)
+    ##########
+    if startup_profile.enabled():
+        # The connection is otherwise only opened by the first query
+        with startup_profile.phase('database connection'):
+            db.connection().select('SELECT 1')
+        persistence.flush()
+        startup_profile.finish()
+
+    start_metrics(METRICS_PORT)
+    start_services()
+    start_receiving_updates(updater)
     updater.idle()
+    # The handlers still queued save their sessions while they are drained, so the persistence
+    # is closed only after them
+    stop_services()
+    persistence.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,5 +1,11 @@
+# Installed before the other imports so that they are measured with --profile-startup
+import startup_profile
+startup_profile.install_if_requested()
+
+import asyncio
 import logging
 import os
+import subprocess
 
 import music_tag
 from orator import Model
@@ -12,15 +18,14 @@ from telegram import (
     ReplyKeyboardMarkup, 
 )
 
-import moviepy
-import moviepy.editor 
-
 import localization as lp
 from utils.init1 import translate_key_to, reset_user_data_context, generate_start_over_keyboard, \
 create_user_directory, download_file, increment_usage_counter_for_user, delete_file, \
 generate_module_selector_keyboard, generate_module_selector_video_keyboard, generate_tag_editor_keyboard, \
 generate_music_info, generate_tag_editor_video_keyboard, save_tags_to_file, convert_video
 
+from utils import video_to_video_note
+
 from models.admin import Admin
 from models.user import User
 from dbConfig import db
@@ -385,8 +390,18 @@ def convert_mp4_to_webm(update: Update, context: CallbackContext) -> None:
     chat_id = update.message.chat_id
 
     if video_path:
+        try:
+            video_note_path = asyncio.run(video_to_video_note(video_path, user_data))
+        except (OSError, subprocess.CalledProcessError):
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_CONVERTING, lang),
+                reply_markup=generate_start_over_keyboard(lang)
+            )
+            logger.error("Couldn't convert %s to a video note", video_path, exc_info=True)
+            return
+
         # with open(video_path.format(chat_id, "webm"), 'rb') as video_file:
-        with open(video_path, 'rb') as video_file:
+        with open(video_note_path, 'rb') as video_file:
             # video_file = file_name.split(".")[0]
             # logger.error(video_file)
             #   video_file = str(video_file) +'.webm'
@@ -565,12 +580,8 @@ def display_preview(update: Update, context: CallbackContext) -> None:
             reply_to_message_id=update.effective_message.message_id,
         )
 
-def main():
-    defaults = Defaults(parse_mode=ParseMode.MARKDOWN, timeout=120)
-    persistence = PicklePersistence('persistence_storage')
-    ##########
-    updater = Updater(BOT_TOKEN, persistence=persistence, defaults=defaults)
-    add_handler = updater.dispatcher.add_handler
+def register_handlers(dispatcher) -> None:
+    add_handler = dispatcher.add_handler
     ##########
     add_handler(CommandHandler('start', command_start))
     add_handler(CommandHandler('new', start_over))
@@ -609,6 +620,22 @@ def main():
     ##########
     add_handler(MessageHandler(Filters.regex('^(🇬🇧 English)$'), set_language))
     add_handler(MessageHandler(Filters.regex('^(🇮🇷 فارسی)$'), set_language))
+
+def main():
+    defaults = Defaults(parse_mode=ParseMode.MARKDOWN, timeout=120)
+    with startup_profile.phase('persistence'):
+        persistence = PicklePersistence('persistence_storage')
+    ##########
+    with startup_profile.phase('bot and updater, loading the persisted data'):
+        updater = Updater(BOT_TOKEN, persistence=persistence, defaults=defaults)
+    with startup_profile.phase('handler registration'):
+        register_handlers(updater.dispatcher)
+    ##########
+    if startup_profile.enabled():
+        # The connection is otherwise only opened by the first query
+        with startup_profile.phase('database connection'):
+            db.connection().select('SELECT 1')
+        startup_profile.finish()
     ##########
     updater.start_polling()
     updater.idle()
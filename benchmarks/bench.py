@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Benchmark the media conversions and compare two benchmark runs.
+
+Run it from the root of the repository:
+
+    python -m benchmarks.bench generate
+    python -m benchmarks.bench run -o before.json
+    python -m benchmarks.bench run -o after.json
+    python -m benchmarks.bench compare before.json after.json
+
+Every operation runs in a fresh interpreter, so the peak RSS of one run doesn't leak into the
+next one and the CPU time includes the ffmpeg processes the operation starts.
+"""
+from optparse import OptionParser
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks.fixtures import FIXTURES, ffmpeg_version, generate_fixtures
+from benchmarks.operations import OPERATIONS, OPERATION_FIXTURES
+
+DEFAULT_MEDIA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media')
+
+# What every measurement reports; a higher value is always worse
+METRICS = ('wall_s', 'cpu_s', 'peak_rss_kb', 'output_bytes')
+
+
+def _cpu_time():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def measure(operation, fixture):
+    """Run a single operation on a single fixture in this process and print what it cost.
+    This is what `run` starts in a child process for every measurement."""
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        cpu_before = _cpu_time()
+        started_at = time.perf_counter()
+        output = OPERATIONS[operation](fixture, work_dir)
+        wall = time.perf_counter() - started_at
+        cpu = _cpu_time() - cpu_before
+        # ru_maxrss is in kilobytes on Linux; the children value is the biggest ffmpeg process
+        peak_rss = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        )
+        output_size = os.path.getsize(output)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps({
+        'wall_s': round(wall, 4),
+        'cpu_s': round(cpu, 4),
+        'peak_rss_kb': peak_rss,
+        'output_bytes': output_size,
+    }))
+
+
+def run_one(operation, fixture):
+    """Measure an operation in a child process and return the measurement"""
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.bench', 'measure', operation, fixture],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True
+    )
+
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run(media_directory, repeat, only, output_file):
+    """Run every benchmark `repeat` times and write the medians to `output_file`"""
+    missing = [name for name in FIXTURES if not os.path.exists(os.path.join(media_directory, name))]
+    if missing:
+        sys.exit(f"Missing fixtures: {', '.join(missing)}. Run `python -m benchmarks.bench generate` first")
+
+    results = {}
+    for operation, fixtures in OPERATION_FIXTURES.items():
+        if only and operation not in only:
+            continue
+        for fixture in fixtures:
+            name = f"{operation}/{fixture}"
+            path = os.path.abspath(os.path.join(media_directory, fixture))
+            runs = [run_one(operation, path) for _ in range(repeat)]
+            results[name] = {metric: statistics.median(r[metric] for r in runs) for metric in METRICS}
+            results[name]['runs'] = runs
+            print(
+                f"{name:<42} {results[name]['wall_s']:>8.3f}s wall {results[name]['cpu_s']:>8.3f}s cpu "
+                f"{results[name]['peak_rss_kb'] / 1024:>8.1f}MB rss {results[name]['output_bytes']:>11} bytes"
+            )
+
+    with open(output_file, 'w', encoding='utf-8') as results_file:
+        json.dump({
+            'meta': {
+                'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'ffmpeg': ffmpeg_version(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'repeat': repeat,
+            },
+            'results': results,
+        }, results_file, indent=2)
+    print(f"Wrote the results to {output_file}")
+
+
+def compare(old_file, new_file, threshold):
+    """Print how every benchmark changed between two runs.
+
+    **Returns:**
+     The names of the benchmarks that got worse by more than `threshold` percent
+    """
+    with open(old_file, encoding='utf-8') as old, open(new_file, encoding='utf-8') as new:
+        old, new = json.load(old), json.load(new)
+
+    for key in ('ffmpeg', 'cpu_count'):
+        if old['meta'].get(key) != new['meta'].get(key):
+            print(f"Warning: the runs differ in {key}: {old['meta'].get(key)} vs {new['meta'].get(key)}")
+
+    regressions = []
+    for name in sorted(set(old['results']) | set(new['results'])):
+        if name not in old['results'] or name not in new['results']:
+            print(f"{name}: only in {old_file if name in old['results'] else new_file}")
+            continue
+
+        changes = []
+        for metric in METRICS:
+            before, after = old['results'][name][metric], new['results'][name][metric]
+            change = (after - before) / before * 100 if before else 0.0
+            if change > threshold:
+                changes.append(f"{metric} {before} -> {after} ({change:+.1f}%) REGRESSION")
+                if name not in regressions:
+                    regressions.append(name)
+            else:
+                changes.append(f"{metric} {before} -> {after} ({change:+.1f}%)")
+        print(f"{name}\n    " + "\n    ".join(changes))
+
+    return regressions
+
+
+def main():
+    """Main script. Get options and arguments"""
+    usage = ("usage: %prog generate [options]\n"
+             "       %prog run [options]\n"
+             "       %prog compare [options] <old results> <new results>")
+    parser = OptionParser(usage)
+    parser.add_option("-d", "--media",
+                      action="store", type="string", dest="media", default=DEFAULT_MEDIA_DIRECTORY,
+                      help="the directory of the fixture media")
+    parser.add_option("-f", "--force",
+                      action="store_true", dest="force", default=False,
+                      help="generate: regenerate the fixtures that already exist")
+    parser.add_option("-r", "--repeat",
+                      action="store", type="int", dest="repeat", default=3,
+                      help="run: how many times to run every benchmark, the median is reported")
+    parser.add_option("--only",
+                      action="append", type="choice", choices=list(OPERATIONS), dest="only", default=[],
+                      help="run: benchmark only this operation, can be given more than once")
+    parser.add_option("-o", "--output",
+                      action="store", type="string", dest="output", default="benchmark.json",
+                      help="run: the file to write the results to")
+    parser.add_option("-t", "--threshold",
+                      action="store", type="float", dest="threshold", default=10.0,
+                      help="compare: the percentage a metric may get worse by before it is a regression")
+
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("missing command")
+    command, args = args[0], args[1:]
+
+    if command == 'generate' and not args:
+        generate_fixtures(options.media, options.force)
+    elif command == 'run' and not args:
+        run(options.media, options.repeat, options.only, options.output)
+    elif command == 'compare' and len(args) == 2:
+        regressions = compare(args[0], args[1], options.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {options.threshold}%")
+            sys.exit(1)
+    elif command == 'measure' and len(args) == 2:
+        measure(args[0], args[1])
+    else:
+        parser.error("incorrect command or number of arguments")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Generate the fixture media of the benchmarks with ffmpeg's lavfi sources, so every machine
+benchmarks the exact same input without any media being checked into the repo"""
+import os
+import subprocess
+
+# name -> ffmpeg arguments between the `ffmpeg -y` and the output file
+FIXTURES = {
+    'voice_short.ogg': [
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000:duration=5',
+        '-c:a', 'libopus', '-b:a', '32k',
+    ],
+    'voice_long.ogg': [
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000:duration=300',
+        '-c:a', 'libopus', '-b:a', '32k',
+    ],
+    'video_720p.mp4': [
+        '-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=30:duration=15',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:duration=15',
+        '-c:v', 'libx264', '-preset', 'medium', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest',
+    ],
+    'video_1080p.mp4': [
+        '-f', 'lavfi', '-i', 'testsrc2=size=1920x1080:rate=30:duration=15',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:duration=15',
+        '-c:v', 'libx264', '-preset', 'medium', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest',
+    ],
+    'artwork_large.jpg': [
+        '-f', 'lavfi', '-i', 'mandelbrot=size=3000x3000',
+        '-frames:v', '1', '-q:v', '2',
+    ],
+    'music.mp3': [
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100:duration=240',
+        '-c:a', 'libmp3lame', '-b:a', '320k',
+    ],
+}
+
+
+def ffmpeg_version():
+    """The first line of `ffmpeg -version`, recorded with the results"""
+    result = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+
+    return result.stdout.splitlines()[0]
+
+
+def generate_fixtures(directory, force=False):
+    """Create the missing fixtures in `directory` and return their paths by name"""
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+
+    for name, arguments in FIXTURES.items():
+        path = os.path.join(directory, name)
+        if force or not os.path.exists(path):
+            print(f"Generating {name}")
+            subprocess.run(
+                ['ffmpeg', '-y', '-loglevel', 'error'] + arguments + ['-fflags', '+bitexact', path],
+                check=True
+            )
+        paths[name] = path
+
+    return paths
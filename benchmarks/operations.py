@@ -0,0 +1,104 @@
+"""The benchmarked operations. Each one takes the path of a fixture and a scratch directory,
+runs the conversion the way the bot does and returns the path of its output"""
+import asyncio
+import os
+import shutil
+
+# operation -> the fixtures it is benchmarked with
+OPERATION_FIXTURES = {
+    'voice_to_mp3': ('voice_short.ogg', 'voice_long.ogg'),
+    'video_to_gif': ('video_720p.mp4', 'video_1080p.mp4'),
+    'video_to_animation': ('video_720p.mp4', 'video_1080p.mp4'),
+    'video_to_video_note': ('video_720p.mp4', 'video_1080p.mp4'),
+    'convert_video': ('video_720p.mp4', 'video_1080p.mp4'),
+    'convert_image': ('artwork_large.jpg',),
+    'save_tags_to_file': ('music.mp3',),
+}
+
+
+def _copy_to(fixture, work_dir):
+    copy = os.path.join(work_dir, os.path.basename(fixture))
+    shutil.copyfile(fixture, copy)
+
+    return copy
+
+
+def voice_to_mp3(fixture, work_dir):
+    from utils import myffmpegcommand
+
+    return asyncio.run(myffmpegcommand(_copy_to(fixture, work_dir)))
+
+
+def video_to_gif(fixture, work_dir):
+    from utils import video_to_gif as convert
+
+    return asyncio.run(convert(_copy_to(fixture, work_dir)))
+
+
+def video_to_animation(fixture, work_dir):
+    from utils import video_to_animation as convert
+
+    return asyncio.run(convert(_copy_to(fixture, work_dir)))
+
+
+def video_to_video_note(fixture, work_dir):
+    from utils import video_to_video_note as convert
+
+    return asyncio.run(convert(_copy_to(fixture, work_dir)))
+
+
+def _prepare_i1_media(fixture, work_dir, chat_id):
+    # utils.i1 reads from ./input_media and writes to ./output_media
+    os.makedirs(os.path.join(work_dir, 'input_media'), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'output_media'), exist_ok=True)
+    input_type = fixture.rsplit('.', 1)[-1]
+    shutil.copyfile(fixture, os.path.join(work_dir, 'input_media', f"{chat_id}.{input_type}"))
+    os.chdir(work_dir)
+
+    return input_type
+
+
+def convert_video(fixture, work_dir):
+    from utils.i1 import convert_video as convert
+
+    input_type = _prepare_i1_media(fixture, work_dir, 'benchmark')
+    convert('benchmark', input_type, 'gif')
+
+    return os.path.join(work_dir, 'output_media', 'benchmark.gif')
+
+
+def convert_image(fixture, work_dir):
+    from utils.i1 import convert_image as convert
+
+    input_type = _prepare_i1_media(fixture, work_dir, 'benchmark')
+    convert('benchmark', input_type, 'png')
+
+    return os.path.join(work_dir, 'output_media', 'benchmark.png')
+
+
+def save_tags_to_file(fixture, work_dir):
+    from utils import save_tags_to_file as save
+
+    artwork = os.path.join(os.path.dirname(fixture), 'artwork_large.jpg')
+    tags = {
+        'artist': 'Benchmark Artist',
+        'title': 'Benchmark Title',
+        'album': 'Benchmark Album',
+        'genre': 'Benchmark',
+        'year': '2026',
+        'disknumber': '1',
+        'tracknumber': '1',
+    }
+
+    return save(_copy_to(fixture, work_dir), tags, artwork)
+
+
+OPERATIONS = {
+    'voice_to_mp3': voice_to_mp3,
+    'video_to_gif': video_to_gif,
+    'video_to_animation': video_to_animation,
+    'video_to_video_note': video_to_video_note,
+    'convert_video': convert_video,
+    'convert_image': convert_image,
+    'save_tags_to_file': save_tags_to_file,
+}
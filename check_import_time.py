@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Check that importing the bot stays within an import time budget and doesn't pull in any
+of the heavy media libraries, which are only meant to be loaded on first use"""
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+
+# Top level packages that must not be imported at startup. PIL isn't one of them, music_tag
+# needs it to read the album art and imports it right away.
+HEAVY_PACKAGES = ('moviepy', 'numpy', 'imageio', 'ffmpy', 'ffmpeg', 'pyheif', 'requests')
+
+
+def measure_imports(module):
+    """Import `module` in a fresh interpreter with `-X importtime`
+
+    Returns a list of (cumulative microseconds, module name) of every imported module. The
+    imports that failed, e.g. optional ones in a `try`, are reported by `-X importtime` as well,
+    so only the modules found in `sys.modules` afterwards are listed.
+
+    dbConfig.py reads `DB_PORT` at import time and fails without it, so it is set to the
+    default MySQL port when the environment doesn't have it. Nothing connects to the database.
+    """
+    env = dict(os.environ)
+    env.setdefault('DB_PORT', '3306')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import sys, {module}; print('\\n'.join(sys.modules))"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=env
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        sys.exit(f"Couldn't import {module}")
+
+    loaded = set(result.stdout.split())
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self_time, cumulative, name = line[len('import time:'):].split('|')
+        if name.strip() in loaded:
+            imports.append((int(cumulative), name.rstrip()))
+
+    return imports
+
+
+def main():
+    """Main script. Get options and arguments"""
+    usage = "usage: %prog [options] [module]"
+    parser = OptionParser(usage)
+    parser.add_option("-b", "--budget",
+                      action="store", type="float", dest="budget", default=1500.0,
+                      help="the maximum import time in milliseconds")
+    parser.add_option("-n", "--top",
+                      action="store", type="int", dest="top", default=15,
+                      help="how many of the slowest top level imports to list")
+
+    options, args = parser.parse_args()
+    if len(args) > 1:
+        parser.error("incorrect number of arguments")
+    module = args[0] if args else 'Cover'
+
+    imports = measure_imports(module)
+    # Top level imports aren't indented, their cumulative time includes their dependencies
+    top_level = [(cumulative, name.strip()) for cumulative, name in imports if not name.startswith('  ')]
+    total_ms = sum(cumulative for cumulative, _name in top_level) / 1000
+    heavy = sorted({
+        name.strip() for _cumulative, name in imports
+        if name.strip().split('.')[0] in HEAVY_PACKAGES
+    })
+
+    print(f"Importing {module} took {total_ms:.0f}ms (budget {options.budget:.0f}ms)")
+    for cumulative, name in sorted(top_level, reverse=True)[:options.top]:
+        print(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+    failed = False
+    if heavy:
+        print(f"Heavy modules imported at startup: {', '.join(heavy)}")
+        failed = True
+    if total_ms > options.budget:
+        print("Over budget")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
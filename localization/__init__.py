@@ -29,6 +29,8 @@ ERR_ON_READING_TAGS = "ERR_ON_READING_TAGS"
 ERR_ON_UPDATING_TAGS = "ERR_ON_UPDATING_TAGS"
 ERR_ON_UPLOADING = "ERR_ON_UPLOADING"
 ERR_NOT_IMPLEMENTED = "ERR_NOT_IMPLEMENTED"
+ERR_ON_CONVERTING = "ERR_ON_CONVERTING"
+ERR_TOO_MANY_REQUESTS = "ERR_TOO_MANY_REQUESTS"
 ERR_OUT_OF_RANGE = "ERR_OUT_OF_RANGE"
 ERR_MALFORMED_RANGE = "ERR_MALFORMED_RANGE"
 BTN_TAG_EDITOR = "BTN_TAG_EDITOR"
@@ -197,6 +199,14 @@ keys = {
         "en": "This feature has not been implemented yet. Sorry!",
         "fa": "این قابلیت هنوز پیاده سازی نشده. شرمنده!",
     },
+    ERR_ON_CONVERTING: {
+        "en": f"Sorry, I couldn't convert your file... {REPORT_BUG_MESSAGE_EN}",
+        "fa": f"متاسفم، نتونستم فایلت رو تبدیل کنم... {REPORT_BUG_MESSAGE_FA}",
+    },
+    ERR_TOO_MANY_REQUESTS: {
+        "en": "I'm busy converting other files right now. Please try again in a minute.",
+        "fa": "الان سرم شلوغه و دارم فایل های دیگه رو تبدیل می کنم. لطفا یه دقیقه دیگه دوباره امتحان کن.",
+    },
     BTN_TAG_EDITOR: {
         "en": "🎵 Tag Editor",
         "fa": "🎵 تغییر تگ ها",
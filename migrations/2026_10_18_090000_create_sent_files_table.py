@@ -0,0 +1,21 @@
+# pylint: disable=invalid-name
+
+from orator.migrations import Migration
+
+
+class CreateSentFilesTable(Migration):
+
+    def up(self):
+        with self.schema.create('sent_files') as table:
+            table.increments('id')
+            table.string('source_unique_id')
+            table.string('operation', 32)
+            table.string('params_hash', 64)
+            table.string('file_id')
+
+            table.unique(['source_unique_id', 'operation', 'params_hash'])
+
+            table.timestamps()
+
+    def down(self):
+        self.schema.drop('sent_files')
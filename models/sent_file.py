@@ -0,0 +1,5 @@
+from orator import Model
+
+
+class SentFile(Model):
+    __fillable__ = ['source_unique_id', 'operation', 'params_hash', 'file_id']
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Replay recorded Telegram updates against a locally running webhook"""
+from optparse import OptionParser
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_updates(record_file):
+    """Read the updates recorded with RECORD_UPDATES_PATH, one JSON object per line"""
+    with open(record_file, encoding='utf-8') as updates:
+        for line in updates:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def post_update(url, update):
+    """POST a single update to the webhook the way Telegram does, return the HTTP status"""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.status
+
+
+def replay(record_file, url, delay, concurrency, renumber):
+    """Send every recorded update to the webhook and report how long it took"""
+    started_at = time.monotonic()
+    statuses = {}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for update_id, update in enumerate(read_updates(record_file), start=1):
+            if renumber:
+                update['update_id'] = update_id
+            futures.append(executor.submit(post_update, url, update))
+            if delay:
+                time.sleep(delay)
+
+        for future in futures:
+            try:
+                status = future.result()
+            except OSError as error:
+                status = type(error).__name__
+            statuses[status] = statuses.get(status, 0) + 1
+
+    elapsed = time.monotonic() - started_at
+    total = sum(statuses.values())
+    print(f"Replayed {total} updates in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.1f}/s)")
+    for status, count in sorted(statuses.items(), key=str):
+        print(f"  {status}: {count}")
+
+
+def main():
+    """Main script. Get options and arguments"""
+    usage = "usage: %prog [options] <recorded updates file>"
+    parser = OptionParser(usage)
+    parser.add_option("-u", "--url",
+                      action="store", type="string", dest="url",
+                      default="http://127.0.0.1:8443/telegram",
+                      help="the webhook URL, including the secret path part")
+    parser.add_option("-d", "--delay",
+                      action="store", type="float", dest="delay", default=0.0,
+                      help="seconds to wait between two updates")
+    parser.add_option("-c", "--concurrency",
+                      action="store", type="int", dest="concurrency", default=1,
+                      help="how many requests to have in flight at once")
+    parser.add_option("--renumber",
+                      action="store_true", dest="renumber", default=False,
+                      help="give the updates new sequential update ids")
+
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("incorrect number of arguments")
+    replay(args[0], options.url, options.delay, options.concurrency, options.renumber)
+
+if __name__ == "__main__":
+    main()
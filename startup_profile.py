@@ -0,0 +1,186 @@
+"""Startup profiling for the bot entry points.
+
+Run `python Cover.py --profile-startup` to get a report of how long every module took to
+import and how long the startup phases (persistence, handler registration, database
+connection, ...) took, instead of starting the bot. Only the standard library is used here, so
+it can be installed before anything else is imported.
+"""
+import sys
+import time
+from contextlib import contextmanager
+from importlib.abc import MetaPathFinder
+
+FLAG = '--profile-startup'
+
+_profile = None
+
+
+class _TimedLoader:
+    """Wraps the loader of a module to time the execution of the module"""
+
+    def __init__(self, loader, profile: 'StartupProfile') -> None:
+        self._loader = loader
+        self._profile = profile
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module) -> None:
+        # Tools looking at the loader (importlib.resources, reload, ...) should see the real one
+        module.__loader__ = self._loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self._loader
+
+        self._profile.import_started()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._profile.import_finished(module.__name__)
+
+    def __getattr__(self, name: str):
+        return getattr(self._loader, name)
+
+
+class _ImportTimer(MetaPathFinder):
+    """Finds modules with the other finders and wraps their loaders with `_TimedLoader`"""
+
+    def __init__(self, profile: 'StartupProfile') -> None:
+        self._profile = profile
+
+    def find_spec(self, fullname: str, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = _TimedLoader(spec.loader, self._profile)
+
+            return spec
+
+        return None
+
+
+class StartupProfile:
+    """Collects the import times of the modules and the durations of the startup phases"""
+
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.imports = []
+        self.import_total = 0.0
+        self.phases = []
+        self._stack = []
+        self._finder = _ImportTimer(self)
+
+    def install(self) -> None:
+        sys.meta_path.insert(0, self._finder)
+
+    def uninstall(self) -> None:
+        if self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+
+    def import_started(self) -> None:
+        # [start time, time spent in nested imports]
+        self._stack.append([time.perf_counter(), 0.0])
+
+    def import_finished(self, name: str) -> None:
+        started_at, nested = self._stack.pop()
+        cumulative = time.perf_counter() - started_at
+        self.imports.append((name, cumulative, cumulative - nested))
+        if self._stack:
+            self._stack[-1][1] += cumulative
+        else:
+            self.import_total += cumulative
+
+    @contextmanager
+    def phase(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started_at))
+
+    def report(self, top: int = 25) -> str:
+        """Build the report, the slowest entries first
+
+        **Keyword arguments:**
+         - top (int) -- How many modules to list
+
+        **Returns:**
+         The report as text
+        """
+        total = time.perf_counter() - self.started_at
+        lines = [f"Startup took {total * 1000:.1f}ms", "", "Phases:"]
+
+        phases = [('imports', self.import_total)] + self.phases
+        for name, duration in sorted(phases, key=lambda phase: phase[1], reverse=True):
+            lines.append(f"  {duration * 1000:9.1f}ms  {name}")
+
+        lines += ["", f"Slowest of {len(self.imports)} imported modules (cumulative, self):"]
+        for name, cumulative, self_time in sorted(self.imports, key=lambda entry: entry[1], reverse=True)[:top]:
+            lines.append(f"  {cumulative * 1000:9.1f}ms  {self_time * 1000:9.1f}ms  {name}")
+
+        return "\n".join(lines)
+
+
+def install_if_requested(argv: list = None) -> bool:
+    """Start profiling if `--profile-startup` is in the command line arguments. Has to be
+    called before the imports that should be measured.
+
+    **Keyword arguments:**
+     - argv (list) -- The command line arguments, `sys.argv` by default. The flag is removed
+
+    **Returns:**
+     Whether profiling is enabled
+    """
+    global _profile
+
+    argv = sys.argv if argv is None else argv
+    if FLAG not in argv:
+        return False
+
+    argv.remove(FLAG)
+    if _profile is None:
+        _profile = StartupProfile()
+        _profile.install()
+        sys.excepthook = _report_on_crash(sys.excepthook)
+
+    return True
+
+
+def _report_on_crash(excepthook):
+    # A failing import (or anything else) still gets a report of what happened up to that point
+    def report_and_raise(exc_type, exc_value, exc_traceback) -> None:
+        _profile.uninstall()
+        print(_profile.report(), file=sys.stderr)
+        print(file=sys.stderr)
+        excepthook(exc_type, exc_value, exc_traceback)
+
+    return report_and_raise
+
+
+def enabled() -> bool:
+    return _profile is not None
+
+
+@contextmanager
+def phase(name: str):
+    """Time a startup phase. Does nothing when profiling isn't enabled.
+
+    **Keyword arguments:**
+     - name (str) -- The name of the phase in the report
+    """
+    if _profile is None:
+        yield
+        return
+
+    with _profile.phase(name):
+        yield
+
+
+def finish() -> None:
+    """Print the report and exit, so the bot doesn't actually start"""
+    _profile.uninstall()
+    print(_profile.report())
+    sys.exit(0)
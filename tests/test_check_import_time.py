@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import check_import_time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class CheckImportTimeTest(unittest.TestCase):
+    def test_entry_point_imports_no_heavy_package(self) -> None:
+        # The budget depends on the host, only the heavy imports are checked here
+        result = subprocess.run(
+            [sys.executable, 'check_import_time.py', '--budget', '60000', 'Cover'],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True
+        )
+
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertNotIn('Heavy modules', result.stdout)
+
+    def test_failed_imports_are_not_counted(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'optional_numpy.py'), 'w') as module:
+                module.write("try:\n    import numpy.missing_module\nexcept ImportError:\n    pass\n")
+            python_path = os.pathsep.join(filter(None, (directory, os.environ.get('PYTHONPATH'))))
+            with mock.patch.dict(os.environ, PYTHONPATH=python_path):
+                imports = check_import_time.measure_imports('optional_numpy')
+
+        names = [name.strip() for _cumulative, name in imports]
+        self.assertIn('optional_numpy', names)
+        self.assertNotIn('numpy.missing_module', names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import http.client
+import io
+import os
+import re
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+
+import utils
+from utils.downloader import RangeNotSupported, download_in_parallel, download_to_stream
+
+CONTENT = bytes(range(256)) * 40
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serves `CONTENT` with HTTP/1.1 keep-alive, answering ranged requests the way the server
+    is configured to"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        self.server.ranges.append(self.headers.get('Range'))
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+
+        if not match or self.server.mode == 'ignore_range':
+            self._send(200, CONTENT)
+            return
+
+        first, last = int(match.group(1)), min(int(match.group(2)), len(CONTENT) - 1)
+        body = CONTENT[first:last + 1]
+        if self.server.mode == 'short':
+            # Announces the whole range but hangs up half way through
+            self._send(206, body[:len(body) // 2], length=len(body), close=True)
+            return
+
+        self._send(206, body)
+
+    def _send(self, status: int, body: bytes, length: int = None, close: bool = False) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class FileServerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+        self.server.mode = 'ranges'
+        self.server.ranges = []
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/file/path?token=1"
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.destination = os.path.join(self.directory.name, 'file')
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+
+class DownloadInParallelTest(FileServerTestCase):
+    def test_ranges_are_downloaded_into_place(self) -> None:
+        download_in_parallel(self.url, self.destination, len(CONTENT), parts=4, min_part_size=1000)
+
+        with open(self.destination, 'rb') as downloaded:
+            self.assertEqual(downloaded.read(), CONTENT)
+        self.assertEqual(
+            sorted(self.server.ranges),
+            ['bytes=0-2559', 'bytes=2560-5119', 'bytes=5120-7679', 'bytes=7680-10239']
+        )
+
+    def test_small_file_is_downloaded_in_one_range(self) -> None:
+        download_in_parallel(self.url, self.destination, len(CONTENT), parts=4, min_part_size=len(CONTENT))
+
+        self.assertEqual(self.server.ranges, [f"bytes=0-{len(CONTENT) - 1}"])
+
+    def test_ignored_range_raises(self) -> None:
+        self.server.mode = 'ignore_range'
+
+        with self.assertRaises(RangeNotSupported):
+            download_in_parallel(self.url, self.destination, len(CONTENT), parts=4, min_part_size=1000)
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_short_read_is_retried_then_raises(self) -> None:
+        self.server.mode = 'short'
+
+        with self.assertRaises((OSError, http.client.HTTPException)):
+            download_in_parallel(self.url, self.destination, len(CONTENT), parts=2, min_part_size=1000,
+                                 retries=1)
+
+        self.assertFalse(os.path.exists(self.destination))
+        # Every range is tried once more
+        self.assertEqual(len(self.server.ranges), 4)
+
+    def test_file_smaller_than_expected_raises(self) -> None:
+        with self.assertRaises((OSError, http.client.HTTPException)):
+            download_in_parallel(self.url, self.destination, len(CONTENT) + 100, parts=2, min_part_size=1000,
+                                 retries=0)
+
+        self.assertFalse(os.path.exists(self.destination))
+
+
+class DownloadToStreamTest(FileServerTestCase):
+    def test_file_is_written_in_chunks(self) -> None:
+        out = io.BytesIO()
+        chunks = []
+        out.write = lambda chunk: chunks.append(chunk) or io.BytesIO.write(out, chunk)
+
+        with mock.patch('utils.downloader.READ_SIZE', 1000):
+            written = download_to_stream(self.url, out)
+
+        self.assertEqual(written, len(CONTENT))
+        self.assertEqual(out.getvalue(), CONTENT)
+        self.assertEqual(len(chunks), 11)
+        self.assertEqual(self.server.ranges, [None])
+
+
+class DownloadFileTest(FileServerTestCase):
+    def test_ignored_range_falls_back_to_a_single_download(self) -> None:
+        self.server.mode = 'ignore_range'
+        os.makedirs(os.path.join(self.directory.name, 'downloads', '1'))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory.name)
+        downloaded_to = []
+        telegram_file = SimpleNamespace(
+            file_id='file-id',
+            file_size=len(CONTENT),
+            file_path=self.url,
+            download=downloaded_to.append
+        )
+        context = SimpleNamespace(bot=SimpleNamespace(get_file=lambda _file_id: telegram_file))
+        voice = SimpleNamespace(file_id='file-id', mime_type='audio/ogg')
+
+        with mock.patch.object(utils, 'PARALLEL_DOWNLOAD_THRESHOLD', 1):
+            path = utils.download_file(1, voice, 'voice', context)
+
+        self.assertEqual(path, 'downloads/1/file-id.ogg')
+        self.assertEqual(self.server.ranges, [f"bytes=0-{len(CONTENT) - 1}"])
+        # The partial file is gone, and the file is downloaded again the usual way
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(downloaded_to, [path])
@@ -0,0 +1,79 @@
+import tempfile
+import threading
+import time
+import unittest
+from queue import Queue
+
+from telegram import Bot
+from telegram.ext import Dispatcher, JobQueue
+
+from utils.persistence import ShardedSQLitePersistence
+
+USER_ID = 42
+
+
+class EvictIdleUsersTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.persistence = ShardedSQLitePersistence(self.directory.name, shards=2)
+        self.dispatcher = Dispatcher(Bot('123:TOKEN'), Queue(), persistence=self.persistence)
+        self.job_queue = JobQueue()
+        self.job_queue.set_dispatcher(self.dispatcher)
+
+    def tearDown(self) -> None:
+        self.persistence.close()
+        self.directory.cleanup()
+
+    def _be_active(self, seconds_ago: float) -> None:
+        user_data = self.dispatcher.user_data[USER_ID]
+        user_data['language'] = 'fa'
+        self.persistence.refresh_user_data(USER_ID, user_data)
+        self.persistence.update_user_data(USER_ID, user_data)
+        self.persistence._last_seen[USER_ID] = time.monotonic() - seconds_ago
+
+    def _run_job(self) -> None:
+        ran = threading.Event()
+        self.job_queue.start()
+        self.job_queue.run_once(lambda _context: ran.set(), 0)
+        self.assertTrue(ran.wait(5))
+        # Waits for the job and the persistence update the job queue runs after it
+        self.job_queue.stop()
+
+    def test_job_between_activity_and_eviction_keeps_the_user_idle(self) -> None:
+        self._be_active(seconds_ago=10000)
+        self._run_job()
+
+        evicted = self.persistence.evict_idle_users(self.dispatcher.user_data, 3600)
+
+        self.assertEqual(evicted, 1)
+        self.assertNotIn(USER_ID, dict(self.dispatcher.user_data))
+        # The data stays stored and is read back on the next update
+        self.assertEqual(self.dispatcher.user_data[USER_ID]['language'], 'fa')
+
+    def test_active_user_is_kept(self) -> None:
+        self._be_active(seconds_ago=10)
+        self._run_job()
+
+        self.assertEqual(self.persistence.evict_idle_users(self.dispatcher.user_data, 3600), 0)
+        self.assertIn(USER_ID, dict(self.dispatcher.user_data))
+
+    def test_update_looked_up_before_eviction_keeps_its_data(self) -> None:
+        self._be_active(seconds_ago=10000)
+        # The dispatcher looks the data of the update up, then the eviction job runs
+        user_data = self.dispatcher.user_data[USER_ID]
+        self.persistence.evict_idle_users(self.dispatcher.user_data, 3600)
+
+        self.persistence.refresh_user_data(USER_ID, user_data)
+
+        self.assertIs(self.dispatcher.user_data[USER_ID], user_data)
+
+    def test_saving_after_flush(self) -> None:
+        # The updater flushes on SIGTERM, before the scheduled handlers have been drained
+        self.persistence.flush()
+        self._be_active(seconds_ago=0)
+
+        self.assertIsNotNone(self.persistence.load_user_data(USER_ID))
+
+
+if __name__ == '__main__':
+    unittest.main()
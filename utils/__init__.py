@@ -1,24 +1,43 @@
 import os
+import asyncio
+import http.client
 import logging
-import subprocess
-import requests
-
-import ffmpy
 
 from pathlib import Path
 
-from moviepy.editor import *
-
 import music_tag
 from telegram import ReplyKeyboardMarkup
 from telegram.ext import CallbackContext
 
 from models.admin import Admin
-from models.user import User
 from localization import keys
+from utils import metrics, tracing
+from utils.aio import run_ffmpeg
+from utils.animation import ANIMATION_PARAMS, animation_command, can_remux_to_animation, \
+    remux_command as animation_remux_command
+from utils.downloader import download_in_parallel, download_to_stream, RangeNotSupported
+from utils.encoders import ENCODER_PRESETS, audio_encoder_args, with_thread_budget
+from utils.gif import GIF_PRESETS, gif_command
+from utils.probe import prober
+from utils.video_note import VIDEO_NOTE_PARAMS, is_video_note_compliant, remux_command, encode_command
 
 logger = logging.getLogger()
 
+# The parameters of the conversions. They are part of the transcode cache key, so any change
+# to them invalidates the previously cached results.
+VOICE_TO_MP3_PARAMS = {
+    'format': 'mp3',
+    'codec': 'libmp3lame',
+    'bitrate': '128k',
+    'compression_level': ENCODER_PRESETS['voice_to_mp3'],
+}
+# The preset of `video_to_gif` when the caller doesn't pick one
+VIDEO_TO_GIF_PARAMS = GIF_PRESETS['small']
+
+# Files at least this big are downloaded with several ranged requests at once
+PARALLEL_DOWNLOAD_THRESHOLD = int(os.getenv("PARALLEL_DOWNLOAD_THRESHOLD") or 8 * 1024 ** 2)
+PARALLEL_DOWNLOAD_PARTS = int(os.getenv("PARALLEL_DOWNLOAD_PARTS") or 4)
+
 def translate_key_to(key: str, destination_lang: str) -> str:
     """Find the specified key in the `keys` dictionary and returns the corresponding
     value for the given language
@@ -69,28 +88,19 @@ def generate_music_info(tag_editor_context: dict) -> str:
     )
 
 
-def increment_usage_counter_for_user(user_id: int) -> int:
-    """Increment the `number_of_files_sent` column of user with the specified `user_id`.
+def reset_user_data_context(context: CallbackContext) -> None:
+    reset_user_session(context.user_data)
+
+def reset_user_session(user_data) -> None:
+    """Delete the files referenced by the session of a user and reset it, keeping the language
+    and the trace of the request
 
     **Keyword arguments:**
-     - user_id (int) -- The user id of the user
-
-    **Returns:**
-     The new value for `user.number_of_files_sent`
+     - user_data (UserSession) -- The session of the user
     """
-    user = User.where('user_id', '=', user_id).first()
-
-    if user:
-        user.number_of_files_sent = user.number_of_files_sent + 1
-        user.push()
-
-        return user.number_of_files_sent
-
-    raise LookupError(f'User with id {user_id} not found.')
-
-def reset_user_data_context(context: CallbackContext) -> None:
-    user_data = context.user_data
     language = user_data['language'] if ('language' in user_data) else 'en'
+    # The handler resetting the session is still a part of the trace, and so are the next steps
+    trace_id = user_data.get('trace_id', '')
 
     if 'voice_path' in user_data:
         delete_file(user_data['voice_path'])
@@ -112,29 +122,14 @@ def reset_user_data_context(context: CallbackContext) -> None:
         delete_file(user_data['new_video_art_path'])
     if 'gif' in user_data:
         delete_file(user_data['gif'])
+    if 'video_note_path' in user_data:
+        delete_file(user_data['video_note_path'])
 
-    new_user_data = {
-        'convert_video_to_gif': False,
-        'convert_video_to_circle': False,
-        'voice_path': '',
-        'voice_art_path': '',
-        'new_voice_art_path': '',
-        'video_path': '',
-        'video_art_path': '',
-        'new_video_art_path': '',
-        'gif': '',
-        'video_message_id': '',
-        'video_duration': '',
-        'tag_editor': {},
-        'music_path': '',
-        'music_duration': 0,
-        'art_path': '',
-        'new_art_path': '',
-        'current_active_module': '',
-        'music_message_id': 0,
-        'language': language,
-    }
-    context.user_data.update(new_user_data)
+    # Only the language and the trace survive a reset, every other field goes back to its default
+    user_data.clear()
+    user_data['language'] = language
+    if trace_id:
+        user_data['trace_id'] = trace_id
 
 def create_user_directory(user_id: int) -> str:
     """Create a directory for a user with a given id.
@@ -154,35 +149,29 @@ def create_user_directory(user_id: int) -> str:
 
     return user_download_dir
 
-def download_file(user_id: int, file_to_download, file_type: str, context: CallbackContext) -> str:
-    """Download a file using convenience methods of "python-telegram-bot"
+def download_path(user_id: int, file_to_download, file_type: str) -> str:
+    """The path `download_file` saves a file to, known before anything is downloaded
 
     **Keyword arguments:**
      - user_id (int) -- The user's id
      - file_to_download (*) -- The file object to download
-     - file_type (str) -- The type of the file, either 'photo' or 'audio'
-     - context (CallbackContext) -- The context object of the user
+     - file_type (str) -- The type of the file, either 'photo', 'audio', 'video' or 'voice'
 
     **Returns:**
-     The path of the downloaded file
+     The path of the file
     """
     user_download_dir = f"downloads/{user_id}"
-    file_id = ''
     file_extension = ''
 
     if file_type == 'audio':
-        file_id = context.bot.get_file(file_to_download.file_id)
         file_name = file_to_download.file_name
         file_extension = file_name.split(".")[-1]
     elif file_type == 'photo':
-        file_id = context.bot.get_file(file_to_download.file_id)
         file_extension = 'jpg'
     elif file_type == 'video':
-        file_id = context.bot.get_file(file_to_download.file_id)
         file_name = file_to_download.file_name
         file_extension = file_name.split(".")[-1]
     elif file_type == 'voice':
-        file_id = context.bot.get_file(file_to_download.file_id)
         mime_type = file_to_download.mime_type
         file_extension = mime_type.split("/")[-1]
 
@@ -198,12 +187,57 @@ def download_file(user_id: int, file_to_download, file_type: str, context: Callb
         # logger.error(new_voice)
         # logger.error(file_id.file_id)
 
-    file_download_path = f"{user_download_dir}/{file_id.file_id}.{file_extension}"
+    return f"{user_download_dir}/{file_to_download.file_id}.{file_extension}"
 
-    try:
-        file_id.download(f"{user_download_dir}/{file_id.file_id}.{file_extension}")
-    except ValueError as error:
-        raise Exception(f"Couldn't download the file with file_id: {file_id}") from error
+def download_file(user_id: int, file_to_download, file_type: str, context: CallbackContext) -> str:
+    """Download a file using convenience methods of "python-telegram-bot"
+
+    **Keyword arguments:**
+     - user_id (int) -- The user's id
+     - file_to_download (*) -- The file object to download
+     - file_type (str) -- The type of the file, either 'photo' or 'audio'
+     - context (CallbackContext) -- The context object of the user
+
+    **Returns:**
+     The path of the downloaded file
+    """
+    file_download_path = download_path(user_id, file_to_download, file_type)
+
+    return download_file_to(file_download_path, file_to_download.file_id, file_type, context)
+
+def download_file_to(file_download_path: str, file_id: str, file_type: str, context: CallbackContext) -> str:
+    """Download a file by its `file_id`, e.g. one the user sent earlier, to the given path
+
+    **Keyword arguments:**
+     - file_download_path (str) -- The path to save the file to, see `download_path`
+     - file_id (str) -- The Telegram `file_id` of the file
+     - file_type (str) -- The type of the file, only used for the metrics
+     - context (CallbackContext) -- The context object of the user
+
+    **Returns:**
+     The path of the downloaded file
+    """
+    telegram_file = context.bot.get_file(file_id)
+
+    with metrics.phase('download'), tracing.span('download', file_type=file_type, file_size=telegram_file.file_size):
+        if telegram_file.file_size and telegram_file.file_size >= PARALLEL_DOWNLOAD_THRESHOLD \
+                and telegram_file.file_path.startswith(('http://', 'https://')):
+            try:
+                return download_in_parallel(
+                    telegram_file.file_path,
+                    file_download_path,
+                    telegram_file.file_size,
+                    parts=PARALLEL_DOWNLOAD_PARTS
+                )
+            except RangeNotSupported:
+                logger.warning("Ranged downloads aren't supported, downloading %s in one piece", file_id)
+            except (OSError, http.client.HTTPException) as error:
+                raise Exception(f"Couldn't download the file with file_id: {file_id}") from error
+
+        try:
+            telegram_file.download(file_download_path)
+        except ValueError as error:
+            raise Exception(f"Couldn't download the file with file_id: {file_id}") from error
 
     return file_download_path
 
@@ -416,15 +450,26 @@ def ffmpegcommand(voice, mime_type):
     # print(cmd)
     return cmd
 
-def myffmpegcommand(voice_path, user_data):
+async def myffmpegcommand(voice_path, unique_id=None):
     voice = voice_path.split(".")[0]
     new_mime_type = ".mp3"
     new_voice = voice + new_mime_type
     # subprocess.run(["ffmpeg", '-i', voice_path, '-acodec', 'libopus', new_voice, '-y'])
     # subprocess.run(["ffmpeg -i {voice_path} -map 0:a -acodec libmp3lame {new_voice}"])
-    
-    subprocess.run(["ffmpeg", "-n", "-i", voice_path, "-acodec", "libmp3lame", "-ab", "128k", new_voice])
-    user_data['new_voice_art_path'] = new_voice
+
+    info = await prober.probe(voice_path, unique_id)
+    if info.audio_codec == 'mp3' and info.container == 'mp3':
+        # Already what the user asked for
+        new_voice = voice_path
+    elif info.audio_codec == 'mp3':
+        await run_ffmpeg(["ffmpeg", "-y", "-i", voice_path, "-vn", "-acodec", "copy", new_voice])
+    else:
+        await run_ffmpeg(with_thread_budget([
+            "ffmpeg", "-y", "-i", voice_path,
+            *audio_encoder_args(VOICE_TO_MP3_PARAMS),
+            new_voice
+        ]))
+    return new_voice
     # delete_file(user_data['voice_path'])
     # logging.info(user_data['new_voice_art_path'])
     # return
@@ -458,7 +503,37 @@ def myffmpegcommand(voice_path, user_data):
     # result = requests.post(upload_audio_url, files=file)
     # return result
 
-def video_to_gif(video_path, user_data):
+async def stream_voice_to_mp3(voice_file) -> bytes:
+    """Convert a voice message to MP3 by piping it through ffmpeg, without writing the
+    downloaded voice or the converted file to the disk
+
+    **Keyword arguments:**
+     - voice_file (telegram.File) -- The file object returned by `bot.get_file`
+
+    **Returns:**
+     The content of the MP3 file
+    """
+    # ffmpeg converts the voice while it is being downloaded, chunk by chunk
+    def feed(stdin) -> None:
+        with metrics.phase('download'), tracing.span('download', file_type='voice', file_size=voice_file.file_size):
+            try:
+                download_to_stream(voice_file.file_path, stdin)
+            except BrokenPipeError:
+                raise
+            except BaseException as error:
+                raise Exception(f"Couldn't download the file with file_id: {voice_file.file_id}") from error
+
+    return await run_ffmpeg(
+        with_thread_budget([
+            "ffmpeg", "-i", "pipe:0",
+            *audio_encoder_args(VOICE_TO_MP3_PARAMS),
+            "-f", VOICE_TO_MP3_PARAMS['format'],
+            "pipe:1"
+        ]),
+        feed=feed
+    )
+
+async def video_to_gif(video_path, unique_id=None, params=None):
     video = video_path.split(".")[0]
     new_mime_type = ".gif"
     gif = video + new_mime_type
@@ -466,8 +541,46 @@ def video_to_gif(video_path, user_data):
     # logging.error(new_video)
     # subprocess.run(["ffmpeg", "-i", video_path, "-pix_fmt", "rgb24", gif])
     # subprocess.run(["ffmpeg", "-i", video_path, "-movflags", "faststart", "-pix_fmt", "yuv420p", "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2", gif])
-    subprocess.run(["ffmpeg", "-ss", "00:00:00.000", "-i", video_path, "-pix_fmt", "rgb24", "-r", "10", "-s", "320x240", "-t", "00:00:10.000", gif])
-    user_data['gif'] = gif
+    info = await prober.probe(video_path, unique_id)
+    await run_ffmpeg(with_thread_budget(gif_command(video_path, gif, params or VIDEO_TO_GIF_PARAMS, info.frame_rate)))
+
+    return gif
+
+async def video_to_animation(video_path, unique_id=None, params=None):
+    # The video itself may be an .mp4 already
+    animation = video_path.split(".")[0] + "-animation.mp4"
+
+    params = params or ANIMATION_PARAMS
+
+    info = await prober.probe(video_path, unique_id)
+    if can_remux_to_animation(info, params):
+        await run_ffmpeg(animation_remux_command(video_path, animation))
+    else:
+        await run_ffmpeg(with_thread_budget(animation_command(video_path, animation, params)))
+
+    return animation
+
+async def video_to_video_note(video_path, unique_id=None, params=None):
+    """Convert a video to a video note, by copying its streams if it is compliant already
+
+    **Keyword arguments:**
+     - video_path (str) -- The path of the video
+     - unique_id (str) -- The `file_unique_id` of the video, to reuse its cached probe
+     - params (dict) -- The parameters of the conversion, `VIDEO_NOTE_PARAMS` by default
+
+    **Returns:**
+     The path of the video note
+    """
+    params = params or VIDEO_NOTE_PARAMS
+    video_note = video_path.split(".")[0] + "-note.mp4"
+
+    info = await prober.probe(video_path, unique_id)
+    if is_video_note_compliant(info, os.path.getsize(video_path), params):
+        await run_ffmpeg(remux_command(video_path, video_note))
+    else:
+        await run_ffmpeg(with_thread_budget(encode_command(video_path, video_note, params)))
+
+    return video_note
 
 
     # subprocess(["ffmpeg -f gif -i " {video_path outfile.mp4}])
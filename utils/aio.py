@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import metrics, tracing
+
+logger = logging.getLogger()
+
+_ffmpeg_slots = None
+
+
+def set_ffmpeg_concurrency(processes: int) -> None:
+    """Limit how many ffmpeg processes `run_ffmpeg` runs at the same time
+
+    **Keyword arguments:**
+     - processes (int) -- The maximum number of concurrent ffmpeg processes
+    """
+    global _ffmpeg_slots
+    _ffmpeg_slots = asyncio.Semaphore(max(1, processes))
+
+
+async def run_ffmpeg(args: list, input_data: bytes = None, feed=None) -> bytes:
+    """Run ffmpeg (or ffprobe) without blocking the event loop.
+
+    **Keyword arguments:**
+     - args (list) -- The command line, starting with the executable
+     - input_data (bytes) -- What to write to the stdin of the process, if anything
+     - feed (callable) -- Called on another thread with a binary file object writing to the
+       stdin of the process, to pass the input as it comes, e.g. while it is being downloaded.
+       Either this or `input_data`.
+
+    **Returns:**
+     What the process wrote to its stdout
+
+    **Raises:**
+     subprocess.CalledProcessError if the process exits with a non-zero code
+    """
+    if _ffmpeg_slots is None:
+        return await _run_process(args, input_data, feed)
+
+    async with _ffmpeg_slots:
+        return await _run_process(args, input_data, feed)
+
+
+def _describe_command(args: list) -> dict:
+    """The span attributes of an ffmpeg command line: the executable, codecs and format"""
+    attributes = {'command': os.path.basename(args[0])}
+    for flag, name in (('-acodec', 'audio_codec'), ('-c:a', 'audio_codec'), ('-vcodec', 'video_codec'),
+                       ('-c:v', 'video_codec'), ('-f', 'format')):
+        if flag in args[:-1]:
+            attributes[name] = args[args.index(flag) + 1]
+
+    return attributes
+
+
+def _feed_process(feed, descriptor: int) -> None:
+    # Unbuffered, so closing the pipe doesn't flush into a process that is gone already
+    with open(descriptor, 'wb', buffering=0) as stdin:
+        try:
+            feed(stdin)
+        except BrokenPipeError:
+            # ffmpeg stopped reading, its exit code tells why
+            pass
+
+
+async def _run_process(args: list, input_data: bytes = None, feed=None) -> bytes:
+    stdin = subprocess.PIPE if input_data is not None else subprocess.DEVNULL
+    if feed is not None:
+        stdin, write_end = os.pipe()
+
+    with metrics.phase('ffmpeg'), tracing.span('ffmpeg', **_describe_command(args)):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+        except BaseException:
+            if feed is not None:
+                os.close(write_end)
+            raise
+        finally:
+            if feed is not None:
+                os.close(stdin)
+
+        feeder = None
+        if feed is not None:
+            feeder = asyncio.ensure_future(asyncio.to_thread(_feed_process, feed, write_end))
+        stdout, stderr = await process.communicate(input_data)
+        if feeder is not None:
+            # A failed download explains a failed conversion better than the exit code does
+            await feeder
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+
+    return stdout
+
+
+class AsyncRuntime:
+    """An asyncio event loop running in its own thread.
+
+    The Telegram handlers stay synchronous; they hand coroutines over to this loop, where ffmpeg
+    runs as asyncio subprocesses and the blocking Telegram downloads and uploads run on the
+    loop's thread pool. A process can then have far more conversions in flight than it has
+    threads.
+
+    **Keyword arguments:**
+     - ffmpeg_processes (int) -- How many ffmpeg processes may run at the same time
+     - io_threads (int) -- How many threads to use for blocking downloads and uploads
+    """
+
+    def __init__(self, ffmpeg_processes: int, io_threads: int) -> None:
+        self.ffmpeg_processes = ffmpeg_processes
+        self.io_threads = io_threads
+
+        self.loop = None
+        self._thread = None
+
+    def start(self) -> None:
+        """Start the event loop thread"""
+        if self._thread is not None:
+            return
+
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.io_threads, thread_name_prefix='aio-io'))
+
+        def run_loop() -> None:
+            asyncio.set_event_loop(self.loop)
+            set_ffmpeg_concurrency(self.ffmpeg_processes)
+            self.loop.call_soon(ready.set)
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run_loop, name='aio-runtime', daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self) -> None:
+        """Wait for the running coroutines and stop the event loop"""
+        if self._thread is None:
+            return
+
+        async def drain() -> None:
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            await self.loop.shutdown_default_executor()
+
+        asyncio.run_coroutine_threadsafe(drain(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self._thread = None
+
+    def submit(self, coroutine):
+        """Schedule a coroutine on the event loop from any thread
+
+        **Keyword arguments:**
+         - coroutine (coroutine) -- The coroutine to run
+
+        **Returns:**
+         A `concurrent.futures.Future` of the result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
@@ -0,0 +1,80 @@
+"""Video to animation conversion as a muted MP4.
+
+Telegram plays a silent MP4 sent with `sendAnimation` exactly like a GIF, and turns uploaded
+GIFs into such MP4s on its side anyway. H.264 keeps every color and only stores what changes
+between frames, so the MP4 is usually a fraction of the size of the GIF and much faster to
+encode.
+"""
+from utils.encoders import ENCODER_PRESETS, video_encoder_args
+
+# The parameters of the conversion, also part of the transcode cache and sent files keys
+ANIMATION_PARAMS = {
+    'format': 'mp4',
+    'codec': 'libx264',
+    'preset': ENCODER_PRESETS['animation'],
+    'crf': 26,
+    'max_side': 720,
+    'duration': 10,
+}
+
+
+def animation_filter(params: dict) -> str:
+    """The ffmpeg filter graph scaling a video down to the animation size. H.264 with yuv420p
+    needs even dimensions, hence the second scale."""
+    max_side = params['max_side']
+
+    return (
+        f"scale='min({max_side},iw)':'min({max_side},ih)':force_original_aspect_ratio=decrease:flags=lanczos,"
+        f"scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    )
+
+
+def can_remux_to_animation(info, params: dict) -> bool:
+    """Whether the video stream of a video can be copied into the animation as it is: H.264,
+    small enough and short enough
+
+    **Keyword arguments:**
+     - info (MediaInfo) -- What ffprobe reported about the video
+     - params (dict) -- The parameters of the conversion, like `ANIMATION_PARAMS`
+    """
+    return (
+        info.video_codec == 'h264'
+        and info.pix_fmt == 'yuv420p'
+        and 0 < max(info.width, info.height) <= params['max_side']
+        and 0 < info.duration <= params['duration']
+    )
+
+
+def remux_command(video_path: str, animation_path: str) -> list:
+    """The ffmpeg command line copying the video stream of a video into a muted MP4"""
+    return [
+        "ffmpeg", "-y", "-i", video_path,
+        "-map", "0:v:0", "-an",
+        "-c:v", "copy",
+        "-movflags", "+faststart",
+        animation_path
+    ]
+
+
+def animation_command(video_path: str, animation_path: str, params: dict) -> list:
+    """The ffmpeg command line converting `video_path` to a muted MP4 at `animation_path`
+
+    **Keyword arguments:**
+     - video_path (str) -- The path of the video
+     - animation_path (str) -- The path to write the MP4 to
+     - params (dict) -- The parameters of the conversion, like `ANIMATION_PARAMS`
+
+    **Returns:**
+     The command line as a list
+    """
+    return [
+        "ffmpeg", "-y",
+        "-t", str(params['duration']), "-i", video_path,
+        "-an",
+        "-vf", animation_filter(params),
+        *video_encoder_args(params),
+        "-pix_fmt", "yuv420p",
+        # The index goes to the start of the file, so the clients can play it while downloading
+        "-movflags", "+faststart",
+        animation_path
+    ]
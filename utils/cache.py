@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger()
+
+
+def transcode_params_key(params: dict) -> str:
+    """Build a stable string out of the conversion parameters, e.g. to be used as a cache key.
+
+    **Keyword arguments:**
+     - params (dict) -- The parameters of the conversion (codec, bitrate, fps, size, ...)
+
+    **Returns:**
+     The parameters serialized with sorted keys
+    """
+    return json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+
+class TranscodeCache:
+    """A disk-backed cache of conversion results keyed on the Telegram `file_unique_id` of
+    the source file and the conversion parameters.
+
+    Entries are evicted in least-recently-used order once the total size of the cached
+    files goes over `max_bytes`. The recency of the entries survives restarts because every
+    hit touches the modification time of the cached file.
+
+    **Keyword arguments:**
+     - directory (str) -- The directory to keep the cached files in
+     - max_bytes (int) -- The maximum total size of the cached files
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    def get(self, file_unique_id: str, params: dict):
+        """Find the cached result of a conversion.
+
+        **Keyword arguments:**
+         - file_unique_id (str) -- The `file_unique_id` of the source file
+         - params (dict) -- The parameters of the conversion
+
+        **Returns:**
+         The path of the cached file or `None`
+        """
+        key = self._key(file_unique_id, params)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            file_name, _size = entry
+            path = os.path.join(self.directory, file_name)
+
+            try:
+                os.utime(path)
+            except OSError:
+                self._drop(key)
+                return None
+
+            self._entries.move_to_end(key)
+
+        return path
+
+    def put(self, file_unique_id: str, params: dict, file_path: str) -> str:
+        """Add the result of a conversion to the cache. The file is hard linked rather than
+        copied, unless the cache is on another file system.
+
+        **Keyword arguments:**
+         - file_unique_id (str) -- The `file_unique_id` of the source file
+         - params (dict) -- The parameters of the conversion
+         - file_path (str) -- The path of the converted file
+
+        **Returns:**
+         The path of the cached file
+        """
+        def link(temp_path: str) -> None:
+            try:
+                os.link(file_path, temp_path)
+            except OSError:
+                shutil.copyfile(file_path, temp_path)
+
+        extension = os.path.splitext(file_path)[1]
+
+        return self._store(file_unique_id, params, extension, os.path.getsize(file_path), link) or file_path
+
+    def put_content(self, file_unique_id: str, params: dict, content: bytes, extension: str) -> str:
+        """Add the result of a conversion that is only in memory, e.g. streamed out of ffmpeg.
+
+        **Keyword arguments:**
+         - file_unique_id (str) -- The `file_unique_id` of the source file
+         - params (dict) -- The parameters of the conversion
+         - content (bytes) -- The content of the converted file
+         - extension (str) -- The extension of the converted file, e.g. '.mp3'
+
+        **Returns:**
+         The path of the cached file, or an empty string if it is too large to be cached
+        """
+        def write(temp_path: str) -> None:
+            with open(temp_path, 'wb') as cached_file:
+                cached_file.write(content)
+
+        return self._store(file_unique_id, params, extension, len(content), write)
+
+    async def get_or_create(self, file_unique_id: str, params: dict, convert) -> str:
+        """Return the cached result of a conversion, or run it and cache its output.
+
+        **Keyword arguments:**
+         - file_unique_id (str) -- The `file_unique_id` of the source file
+         - params (dict) -- The parameters of the conversion
+         - convert (callable) -- A coroutine function without arguments that runs the
+           conversion and returns the path of the converted file
+
+        **Returns:**
+         The path of a file holding the conversion result
+        """
+        if not file_unique_id:
+            return await convert()
+
+        cached_path = await asyncio.to_thread(self.get, file_unique_id, params)
+        if cached_path:
+            return cached_path
+
+        converted_path = await convert()
+        try:
+            await asyncio.to_thread(self.put, file_unique_id, params, converted_path)
+        except OSError:
+            logger.error("Couldn't cache the converted file %s", converted_path, exc_info=True)
+
+        return converted_path
+
+    def _store(self, file_unique_id: str, params: dict, extension: str, size: int, create) -> str:
+        key = self._key(file_unique_id, params)
+        file_name = key + extension
+        cached_path = os.path.join(self.directory, file_name)
+
+        if size > self.max_bytes:
+            return ''
+
+        # Created under a temporary name first, so the cached file appears complete or not at all
+        temp_path = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+        try:
+            create(temp_path)
+            os.replace(temp_path, cached_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._drop(key, delete=False)
+            self._entries[key] = (file_name, size)
+            self._total_bytes += size
+            self._evict()
+
+        return cached_path
+
+    def _key(self, file_unique_id: str, params: dict) -> str:
+        raw_key = f"{file_unique_id}:{transcode_params_key(params)}"
+
+        return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+    def _drop(self, key: str, delete: bool = True) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        file_name, size = entry
+        self._total_bytes -= size
+        if delete:
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._drop(key)
+
+    def _load_index(self) -> None:
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if entry.name.startswith('.tmp-'):
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _mtime, file_name, size in sorted(files):
+            key = os.path.splitext(file_name)[0]
+            self._entries[key] = (file_name, size)
+            self._total_bytes += size
+
+        with self._lock:
+            self._evict()
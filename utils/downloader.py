@@ -0,0 +1,200 @@
+import http.client
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+logger = logging.getLogger()
+
+READ_SIZE = 256 * 1024
+
+
+class RangeNotSupported(Exception):
+    """Raised when the server doesn't answer a ranged request with a part of the file"""
+
+
+class ConnectionPool:
+    """Keeps idle keep-alive connections around so consecutive requests to the same host don't
+    pay for a new TCP and TLS handshake each time.
+
+    **Keyword arguments:**
+     - max_idle (int) -- How many idle connections to keep per host
+     - timeout (float) -- The socket timeout of the connections
+    """
+
+    def __init__(self, max_idle: int = 16, timeout: float = 60) -> None:
+        self.max_idle = max_idle
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def acquire(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release(self, scheme: str, netloc: str, connection: http.client.HTTPConnection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+
+pool = ConnectionPool()
+
+
+def split_ranges(size: int, parts: int, min_part_size: int) -> list:
+    """Split `size` bytes into at most `parts` contiguous `(first, last)` byte ranges
+
+    **Keyword arguments:**
+     - size (int) -- The size of the file
+     - parts (int) -- The maximum number of ranges
+     - min_part_size (int) -- The minimum size of a range
+
+    **Returns:**
+     The list of inclusive byte ranges
+    """
+    parts = max(1, min(parts, size // max(1, min_part_size)))
+    part_size = -(-size // parts)
+
+    return [(first, min(first + part_size, size) - 1) for first in range(0, size, part_size)]
+
+
+def _download_range(url: str, descriptor: int, first: int, last: int, retries: int) -> int:
+    """Download the bytes `first` to `last` of `url` and write them at the same offset of the file
+
+    **Returns:**
+     The number of bytes written
+    """
+    parts = urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else '')
+
+    for attempt in range(retries + 1):
+        connection = pool.acquire(parts.scheme, parts.netloc)
+        offset = first
+        try:
+            connection.request('GET', path, headers={'Range': f"bytes={first}-{last}"})
+            response = connection.getresponse()
+            if response.status != 206:
+                raise RangeNotSupported(f"Expected a partial response, got HTTP {response.status}")
+
+            while offset <= last:
+                chunk = response.read(min(READ_SIZE, last - offset + 1))
+                if not chunk:
+                    raise http.client.IncompleteRead(b'', last - offset + 1)
+                os.pwrite(descriptor, chunk, offset)
+                offset += len(chunk)
+
+            response.read()
+        except RangeNotSupported:
+            # The rest of the response may be the whole file, it's cheaper to drop the connection
+            connection.close()
+            raise
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            if attempt == retries:
+                raise
+            logger.warning("Range %s-%s failed after %s bytes, retrying", first, last, offset - first)
+            continue
+
+        pool.release(parts.scheme, parts.netloc, connection)
+
+        return last - first + 1
+
+
+def download_in_parallel(url: str, destination: str, size: int, parts: int = 4,
+                         min_part_size: int = 4 * 1024 ** 2, retries: int = 2) -> str:
+    """Download a file with several ranged requests at once, each written straight to its place
+    in a file preallocated to the expected size.
+
+    **Keyword arguments:**
+     - url (str) -- The URL of the file
+     - destination (str) -- The path to save the file to
+     - size (int) -- The size of the file, e.g. `telegram.File.file_size`
+     - parts (int) -- How many ranges to download at the same time
+     - min_part_size (int) -- The minimum size of a range, smaller files use fewer ranges
+     - retries (int) -- How many times to retry a range that failed
+
+    **Returns:**
+     The path of the downloaded file
+
+    **Raises:**
+     RangeNotSupported if the server doesn't support ranged requests, in which case the file
+     should be downloaded the usual way
+    """
+    ranges = split_ranges(size, parts, min_part_size)
+    descriptor = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(descriptor, 0, size)
+        else:
+            os.ftruncate(descriptor, size)
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(_download_range, url, descriptor, first, last, retries)
+                for first, last in ranges
+            ]
+            written = sum(future.result() for future in futures)
+    except BaseException:
+        os.close(descriptor)
+        os.remove(destination)
+        raise
+
+    os.close(descriptor)
+
+    if written != size or os.path.getsize(destination) != size:
+        os.remove(destination)
+        # The URL holds the bot token, so it is left out of the message
+        raise IOError(f"Downloaded {written} bytes instead of {size} to {destination}")
+
+    return destination
+
+
+def download_to_stream(url: str, out) -> int:
+    """Download a file in chunks and write each one to `out` as soon as it arrives, e.g. to the
+    stdin of a process that converts the file while it is being downloaded
+
+    **Keyword arguments:**
+     - url (str) -- The URL of the file
+     - out (file object) -- A binary file object to write the file to
+
+    **Returns:**
+     The number of bytes written
+    """
+    parts = urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else '')
+    connection = pool.acquire(parts.scheme, parts.netloc)
+    written = 0
+
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        if response.status != 200:
+            raise IOError(f"Expected the file, got HTTP {response.status}")
+
+        while True:
+            chunk = response.read(READ_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            written += len(chunk)
+    except BaseException:
+        connection.close()
+        raise
+
+    pool.release(parts.scheme, parts.netloc, connection)
+
+    return written
@@ -0,0 +1,175 @@
+"""Which encoder and settings every conversion uses, and how many threads an ffmpeg process gets.
+
+ffmpeg starts as many threads as there are cores by default. That is the fastest for a single
+conversion, but with one ffmpeg process per core already running, every process fights the
+others for the same cores and the whole batch slows down. Each process gets its share of the
+cores instead.
+"""
+import functools
+import logging
+import os
+import subprocess
+
+logger = logging.getLogger()
+
+# Software encoders only, in order of preference, so the bot behaves the same on every host
+# whatever its GPU. The key is the codec the conversion parameters ask for.
+ENCODER_CANDIDATES = {
+    'libx264': ('libx264', 'libopenh264'),
+    'libmp3lame': ('libmp3lame', 'libshine'),
+    'aac': ('aac', 'libfdk_aac'),
+}
+
+# The fastest setting of each output type that still looks or sounds fine there: x264 presets
+# for the videos and the LAME algorithm quality (0 best, 9 fastest) for the voice
+ENCODER_PRESETS = {
+    'animation': 'veryfast',
+    'video_note': 'veryfast',
+    'voice_to_mp3': 7,
+}
+
+# libopenh264 has neither presets nor CRF, it gets a fixed bitrate instead
+OPENH264_BITRATE = '1M'
+
+_threads_per_job = 0
+
+
+def thread_budget(concurrent_jobs: int, cpu_count: int = None) -> int:
+    """How many threads an ffmpeg process can have without oversubscribing the CPU
+
+    **Keyword arguments:**
+     - concurrent_jobs (int) -- How many ffmpeg processes may run at the same time on the host
+     - cpu_count (int) -- The number of cores, `os.cpu_count()` by default
+
+    **Returns:**
+     The number of threads, at least 1
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+
+    return max(1, cpu_count // max(1, concurrent_jobs))
+
+
+def set_threads_per_job(threads: int) -> None:
+    """Set the `-threads` of the ffmpeg commands passed through `with_thread_budget`, 0 lets
+    ffmpeg decide
+
+    **Keyword arguments:**
+     - threads (int) -- The number of threads of an ffmpeg process
+    """
+    global _threads_per_job
+    _threads_per_job = max(0, threads)
+
+
+def with_thread_budget(args: list) -> list:
+    """Limit the decoder, filter and encoder threads of an ffmpeg command line
+
+    **Keyword arguments:**
+     - args (list) -- The command line, starting with `ffmpeg` and ending with the output
+
+    **Returns:**
+     The command line with the thread options, or as it is if no budget has been set
+    """
+    if not _threads_per_job or '-i' not in args:
+        return args
+
+    threads = str(_threads_per_job)
+    first_input = args.index('-i')
+
+    return (
+        args[:1] + ['-filter_threads', threads] + args[1:first_input]
+        + ['-threads', threads] + args[first_input:-1]
+        + ['-threads', threads] + args[-1:]
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def available_encoders() -> frozenset:
+    """The encoders the installed ffmpeg has, read once from `ffmpeg -encoders`
+
+    **Returns:**
+     The encoder names, empty if ffmpeg couldn't be asked
+    """
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-encoders'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        logger.warning("Couldn't list the ffmpeg encoders", exc_info=True)
+        return frozenset()
+
+    # The list follows a legend, e.g. " V....D libx264  libx264 H.264 / AVC / MPEG-4 AVC"
+    _legend, _separator, listing = result.stdout.partition(' ------')
+    names = [line.split()[1] for line in listing.splitlines() if len(line.split()) > 1]
+
+    return frozenset(names)
+
+
+def select_encoder(codec: str) -> str:
+    """The first available encoder for the codec the conversion asks for
+
+    **Keyword arguments:**
+     - codec (str) -- The encoder in the conversion parameters, e.g. 'libx264'
+
+    **Returns:**
+     The encoder to use, `codec` itself if nothing better is known to be available
+    """
+    candidates = ENCODER_CANDIDATES.get(codec, (codec,))
+    available = available_encoders()
+
+    for candidate in candidates:
+        if candidate in available:
+            return candidate
+
+    return candidates[0]
+
+
+def check_encoders() -> None:
+    """Log which encoder every codec is going to use, and the codecs no encoder is available for.
+    Run it at startup, so the first conversion doesn't wait for `ffmpeg -encoders`."""
+    available = available_encoders()
+    if not available:
+        return
+
+    for codec, candidates in ENCODER_CANDIDATES.items():
+        if any(candidate in available for candidate in candidates):
+            logger.info("Encoding %s with %s", codec, select_encoder(codec))
+        else:
+            logger.error("None of the encoders %s is available in ffmpeg", ', '.join(candidates))
+
+
+def video_encoder_args(params: dict) -> list:
+    """The ffmpeg options encoding the video stream with the parameters of a conversion
+
+    **Keyword arguments:**
+     - params (dict) -- The parameters of the conversion, with `codec`, `preset` and `crf`
+
+    **Returns:**
+     The options as a list
+    """
+    encoder = select_encoder(params['codec'])
+    if encoder == 'libx264':
+        return ['-c:v', encoder, '-preset', params['preset'], '-crf', str(params['crf'])]
+
+    return ['-c:v', encoder, '-b:v', OPENH264_BITRATE]
+
+
+def audio_encoder_args(params: dict) -> list:
+    """The ffmpeg options encoding the audio stream with the parameters of a conversion
+
+    **Keyword arguments:**
+     - params (dict) -- The parameters of the conversion, with `codec`, `bitrate` and
+       optionally `compression_level`
+
+    **Returns:**
+     The options as a list
+    """
+    encoder = select_encoder(params['codec'])
+    args = ['-acodec', encoder, '-ab', params['bitrate']]
+    if encoder == 'libmp3lame' and 'compression_level' in params:
+        args += ['-compression_level', str(params['compression_level'])]
+
+    return args
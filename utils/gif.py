@@ -0,0 +1,160 @@
+"""Video to GIF conversion: a palette built for every video and presets that fit Telegram.
+
+A GIF can only hold 256 colors per frame. Converting straight to `rgb24` makes ffmpeg fall
+back to a fixed generic palette, which bands the gradients and dithers noise over every
+frame, and the noise is what makes the file big. `palettegen` builds the palette out of the
+video itself and `paletteuse` maps the frames onto it; both run in the same filter graph, so
+the video is decoded only once.
+"""
+import math
+
+# Ordered from the best looking to the smallest. The dictionaries are also the parameters of
+# the conversion in the transcode cache and sent files keys, so changing a value invalidates
+# what has been converted with it before.
+GIF_PRESETS = {
+    'high': {
+        'format': 'gif',
+        'preset': 'high',
+        'max_side': 480,
+        'fps': 15,
+        'max_colors': 256,
+        'dither': 'sierra2_4a',
+        'duration': 10,
+    },
+    'medium': {
+        'format': 'gif',
+        'preset': 'medium',
+        'max_side': 360,
+        'fps': 12,
+        'max_colors': 192,
+        'dither': 'bayer',
+        'duration': 10,
+    },
+    'small': {
+        'format': 'gif',
+        'preset': 'small',
+        'max_side': 320,
+        'fps': 10,
+        'max_colors': 128,
+        'dither': 'bayer',
+        'duration': 10,
+    },
+    'tiny': {
+        'format': 'gif',
+        'preset': 'tiny',
+        'max_side': 240,
+        'fps': 8,
+        'max_colors': 64,
+        'dither': 'bayer',
+        'duration': 10,
+    },
+}
+
+# The compressed bytes a pixel of a frame takes, roughly, for camera footage. Error diffusion
+# dithering leaves noise that LZW compresses badly; the ordered Bayer pattern repeats itself.
+# Only `paletteuse=diff_mode=rectangle` frames are assumed, which re-encode the changed area.
+_BYTES_PER_PIXEL = {
+    'sierra2_4a': 0.35,
+    'bayer': 0.2,
+}
+
+
+def fit_within(width: int, height: int, max_side: int) -> tuple:
+    """The size of a `width`x`height` frame scaled down, keeping its aspect ratio, so neither
+    side is longer than `max_side`. Smaller frames are not scaled up.
+
+    **Keyword arguments:**
+     - width (int) -- The width of the video
+     - height (int) -- The height of the video
+     - max_side (int) -- The longest a side may be
+
+    **Returns:**
+     The (width, height) of the scaled frame
+    """
+    if not width or not height:
+        return max_side, max_side
+
+    scale = min(1.0, max_side / max(width, height))
+
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def estimate_gif_size(params: dict, duration: float, width: int, height: int) -> int:
+    """Estimate how big a GIF will be before it is encoded.
+
+    **Keyword arguments:**
+     - params (dict) -- One of `GIF_PRESETS`
+     - duration (float) -- The duration of the video in seconds, 0 if it is unknown
+     - width (int) -- The width of the video, 0 if it is unknown
+     - height (int) -- The height of the video, 0 if it is unknown
+
+    **Returns:**
+     The estimated size in bytes
+    """
+    gif_width, gif_height = fit_within(width, height, params['max_side'])
+    seconds = min(duration, params['duration']) if duration else params['duration']
+    frames = max(1, math.ceil(seconds * params['fps']))
+    palette_bytes = 3 * params['max_colors']
+
+    return int(gif_width * gif_height * frames * _BYTES_PER_PIXEL[params['dither']]) + palette_bytes
+
+
+def choose_gif_preset(duration: float, width: int, height: int, max_bytes: int) -> dict:
+    """Pick the best looking preset whose GIF is expected to stay under `max_bytes`, so the
+    conversion doesn't have to be run again with a smaller one.
+
+    **Keyword arguments:**
+     - duration (float) -- The duration of the video in seconds, 0 if it is unknown
+     - width (int) -- The width of the video, 0 if it is unknown
+     - height (int) -- The height of the video, 0 if it is unknown
+     - max_bytes (int) -- The size the GIF should stay under
+
+    **Returns:**
+     One of `GIF_PRESETS`, the smallest one if none of them is expected to fit
+    """
+    for params in GIF_PRESETS.values():
+        if estimate_gif_size(params, duration, width, height) <= max_bytes:
+            return params
+
+    return GIF_PRESETS['tiny']
+
+
+def gif_filter(params: dict, frame_rate: float = 0) -> str:
+    """The ffmpeg filter graph converting a video to a GIF with its own palette. A video with
+    a lower frame rate than the preset keeps its own, instead of duplicating frames."""
+    fps = min(params['fps'], frame_rate) if frame_rate > 0 else params['fps']
+    max_side = params['max_side']
+    dither = params['dither']
+    if dither == 'bayer':
+        dither += ':bayer_scale=3'
+
+    return (
+        f"fps={fps:g},"
+        f"scale='min({max_side},iw)':'min({max_side},ih)':force_original_aspect_ratio=decrease:flags=lanczos,"
+        f"split[frames][copy];"
+        f"[copy]palettegen=max_colors={params['max_colors']}:stats_mode=diff[palette];"
+        f"[frames][palette]paletteuse=dither={dither}:diff_mode=rectangle"
+    )
+
+
+def gif_command(video_path: str, gif_path: str, params: dict, frame_rate: float = 0) -> list:
+    """The ffmpeg command line converting `video_path` to a GIF at `gif_path`
+
+    **Keyword arguments:**
+     - video_path (str) -- The path of the video
+     - gif_path (str) -- The path to write the GIF to
+     - params (dict) -- One of `GIF_PRESETS`
+     - frame_rate (float) -- The frame rate of the video, if it is known
+
+    **Returns:**
+     The command line as a list
+    """
+    return [
+        "ffmpeg", "-y",
+        # Limiting the input rather than the output stops the decoding at the duration
+        "-t", str(params['duration']), "-i", video_path,
+        "-an",
+        "-vf", gif_filter(params, frame_rate),
+        "-loop", "0",
+        gif_path
+    ]
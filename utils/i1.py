@@ -5,11 +5,6 @@ from pathlib import Path
 import logging
 import subprocess
 
-import ffmpeg
-
-import ffmpy, os, pyheif
-from PIL import Image
-
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 import music_tag
@@ -19,6 +14,14 @@ from telegram.ext import CallbackContext
 from models.admin import Admin
 from models.user import User
 from localization import keys
+from utils.lazy import lazy_import
+from utils.probe import probe_file
+
+# Only a few conversions need these, so they are imported on their first use
+ffmpeg = lazy_import('ffmpeg')
+ffmpy = lazy_import('ffmpy')
+pyheif = lazy_import('pyheif')
+Image = lazy_import('PIL.Image')
 
 logger = logging.getLogger()
 
@@ -345,9 +348,13 @@ def convert_video(chat_id, input_type, output_type):
 		input_type: video input type
 		output_type: video output type
 	"""
-	inputs = {'./input_media/{}.{}'.format(chat_id, input_type): None}
+	input_path = './input_media/{}.{}'.format(chat_id, input_type)
+	inputs = {input_path: None}
 	if output_type == "gif":
 		outputs = {'./output_media/{}.{}'.format(chat_id, output_type): '-t 3 -vf "fps=30,scale=320:-1:flags=lanczos,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse" -loop 0'}
+	elif probe_file(input_path).can_copy_to(output_type):
+		# Only the container changes, the streams are copied as they are
+		outputs = {'./output_media/{}.{}'.format(chat_id, output_type): '-map 0:v:0? -map 0:a:0? -c copy'}
 	else:
 		outputs = {'./output_media/{}.{}'.format(chat_id, output_type): None}
 	ff = ffmpy.FFmpeg(
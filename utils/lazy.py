@@ -0,0 +1,49 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    """A stand-in for a module that is only imported when one of its attributes is first used.
+
+    Heavy media libraries (PIL, pyheif, ffmpeg-python, ...) take a noticeable part of the startup
+    time of the bot while most updates never need them. Import them with `lazy_import` instead
+    and they are loaded by the first handler that actually uses them.
+    """
+
+    __slots__ = ('_name', '_module', '_lock')
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+
+        return self._module
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self._module is not None else 'not loaded yet'
+
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """Import a module on its first use
+
+    **Keyword arguments:**
+     - name (str) -- The full name of the module, e.g. 'PIL.Image'
+
+    **Returns:**
+     A LazyModule that imports the module when one of its attributes is accessed
+    """
+    return LazyModule(name)
@@ -0,0 +1,267 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger()
+
+# Seconds, from a quick reply up to a long video conversion
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), registry=None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects the labels {self.labels}, got {tuple(labels)}")
+
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. the number of handled updates"""
+
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down. With `function` it is read from the function on every
+    scrape, which suits values the bot already keeps track of, like queue depths.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function=None, registry=None) -> None:
+        super().__init__(name, documentation, registry=registry)
+        self.function = function
+        self._value = 0
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def _samples(self) -> list:
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                logger.error("Couldn't read the gauge %s", self.name, exc_info=True)
+                return []
+        else:
+            with self._lock:
+                value = self._value
+
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """Counts observations, e.g. durations, into cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS,
+                 registry=None) -> None:
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [count per bucket..., count above the last bucket], sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the body of the `with` block takes"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def _samples(self) -> list:
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+
+        samples = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{_format_value(bound)}"')
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            samples.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            samples.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+
+        return samples
+
+
+class Registry:
+    """The metrics exposed on the `/metrics` endpoint"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+handler_duration = Histogram(
+    'bot_handler_duration_seconds', 'Time spent running a handler', ('handler',)
+)
+queue_wait = Histogram(
+    'bot_queue_wait_seconds', 'Time an update waited for its turn in the scheduler'
+)
+phase_duration = Histogram(
+    'bot_phase_duration_seconds', 'Time spent in a stage of handling a file', ('phase',)
+)
+updates_total = Counter(
+    'bot_updates_total', 'Received updates by media type', ('media_type',)
+)
+errors_total = Counter(
+    'bot_errors_total', 'Logged errors by exception type', ('exception',)
+)
+
+
+def phase(name: str):
+    """Time a stage of the processing, e.g. 'download', 'ffmpeg' or 'db'
+
+    **Keyword arguments:**
+     - name (str) -- The name of the stage
+
+    **Returns:**
+     A context manager timing its body
+    """
+    return phase_duration.time(phase=name)
+
+
+class ErrorCounter(logging.Handler):
+    """Counts the log records that carry an exception, by exception type. The handlers already
+    log every error they catch, so this counts them without touching every `except` block.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.exc_info and record.exc_info[0] is not None:
+            errors_total.inc(exception=record.exc_info[0].__name__)
+
+
+class MetricsServer:
+    """Serves the metrics of a registry on `http://<host>:<port>/metrics` from a daemon thread
+
+    **Keyword arguments:**
+     - host (str) -- The address to listen on
+     - port (int) -- The port to listen on
+     - registry (Registry) -- The metrics to serve
+    """
+
+    def __init__(self, host: str, port: int, registry: Registry = None) -> None:
+        self.host = host
+        self.port = port
+        self.registry = REGISTRY if registry is None else registry
+        self._server = None
+        self._thread = None
+
+    def start(self) -> None:
+        registry = self.registry
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), MetricsRequestHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info("Serving metrics on http://%s:%s/metrics", self.host, self._server.server_port)
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,251 @@
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from telegram.ext import BasePersistence
+
+from utils.session import UserSession
+
+logger = logging.getLogger()
+
+# The first byte of the rows holding a serialized `UserSession`. Rows written by older versions
+# are pickles, which never start with it
+SESSION_FORMAT = b'S'
+
+
+class _Shard:
+    """One SQLite file holding the `user_data` of the users whose id falls into it"""
+
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)'
+        )
+
+    def load(self, user_id: int):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT data FROM user_data WHERE user_id = ?', (user_id,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def save(self, user_id: int, data: bytes) -> None:
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)', (user_id, data)
+            )
+
+    def checkpoint(self) -> None:
+        with self.lock:
+            self.connection.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class LazyUserData(defaultdict):
+    """The `user_data` mapping of the dispatcher. The data of a user is read from the store the
+    first time the user is looked up instead of loading every user at startup.
+    """
+
+    def __init__(self, default_factory=None, *args, store=None, **kwargs) -> None:
+        super().__init__(default_factory, *args, **kwargs)
+        self.store = store
+
+    def __missing__(self, user_id):
+        data = self.store.load_user_data(user_id) if self.store is not None else None
+        if data is None:
+            return super().__missing__(user_id)
+        self[user_id] = data
+
+        return data
+
+    def __copy__(self) -> 'LazyUserData':
+        return type(self)(self.default_factory, self, store=self.store)
+
+    copy = __copy__
+
+
+class ShardedSQLitePersistence(BasePersistence):
+    """Keeps the `user_data` of every user as a row in one of `shards` SQLite files.
+
+    Unlike `PicklePersistence`, which pickles the data of all the users on every flush, only the
+    row of the user whose data has actually changed is written, so saving costs the same no
+    matter how many users the bot has. Users are loaded lazily on their first update.
+
+    Chat data, bot data and conversations aren't used by the bot and aren't stored.
+
+    **Keyword arguments:**
+     - directory (str) -- The directory to create the shard files in
+     - shards (int) -- How many SQLite files to spread the users over
+    """
+
+    def __init__(self, directory: str, shards: int = 16) -> None:
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.directory = directory
+        self.shard_count = max(1, shards)
+
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self._shards = [
+            _Shard(os.path.join(directory, f"user_data_{index}.sqlite3"))
+            for index in range(self.shard_count)
+        ]
+        self._digests = {}
+        self._digests_lock = threading.Lock()
+        self._last_seen = {}
+        # Held while a user is looked at and evicted, so an update can't slip in between
+        self._eviction_lock = threading.Lock()
+        self._user_data = None
+
+    def _shard_of(self, user_id: int) -> _Shard:
+        return self._shards[user_id % self.shard_count]
+
+    def serialize(self, data) -> bytes:
+        if isinstance(data, UserSession):
+            return SESSION_FORMAT + data.to_bytes()
+
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def deserialize(self, raw: bytes):
+        if raw[:1] == SESSION_FORMAT:
+            return UserSession.from_bytes(raw[1:])
+
+        data = pickle.loads(raw)
+        if isinstance(data, dict):
+            data = UserSession.from_dict(data)
+
+        return data
+
+    def load_user_data(self, user_id: int):
+        """Read the data of a user from its shard.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+
+        **Returns:**
+         The stored data or `None` if the user has never been saved
+        """
+        raw = self._shard_of(user_id).load(user_id)
+        if raw is None:
+            return None
+
+        with self._digests_lock:
+            self._digests[user_id] = hashlib.blake2b(raw, digest_size=16).digest()
+
+        try:
+            return self.deserialize(raw)
+        except Exception:
+            logger.error("Couldn't read the stored data of user %s, starting over", user_id, exc_info=True)
+            return None
+
+    def refresh_user_data(self, user_id: int, user_data) -> None:
+        with self._eviction_lock:
+            self._last_seen[user_id] = time.monotonic()
+            # The dispatcher looks the data up before calling this, so the user may have been
+            # evicted in between. The handler is about to use that data, so it is put back.
+            if self._user_data is not None and dict.get(self._user_data, user_id) is not user_data:
+                dict.__setitem__(self._user_data, user_id, user_data)
+
+    def evict_idle_users(self, user_data: LazyUserData, idle_seconds: float, can_evict=None,
+                         on_evict=None) -> int:
+        """Drop the users who haven't sent anything for `idle_seconds` from memory. Their data
+        stays in the store and is read back transparently on their next update.
+
+        **Keyword arguments:**
+         - user_data (LazyUserData) -- The `user_data` mapping of the dispatcher
+         - idle_seconds (float) -- How long a user has to be idle to be evicted
+         - can_evict (callable) -- Called with a user id, may return `False` to keep the user
+         - on_evict (callable) -- Called with the user id and the data right before the data
+           is saved and dropped, e.g. to clean up files. What it changes is saved too, so a
+           session it resets is also reset in the store.
+
+        **Returns:**
+         The number of evicted users
+        """
+        deadline = time.monotonic() - idle_seconds
+        evicted = 0
+        # The dispatcher keeps a copy of what `get_user_data` returns, this is the one in use
+        self._user_data = user_data
+
+        for user_id in list(self._last_seen):
+            with self._eviction_lock:
+                # Checked again under the lock, the user may have sent something since the loop
+                # started
+                last_seen = self._last_seen.get(user_id)
+                if last_seen is None or last_seen > deadline:
+                    continue
+                if can_evict is not None and not can_evict(user_id):
+                    continue
+
+                data = dict.get(user_data, user_id)
+                if data is not None:
+                    if on_evict is not None:
+                        on_evict(user_id, data)
+                    self.update_user_data(user_id, data)
+                    user_data.pop(user_id, None)
+
+                self._last_seen.pop(user_id, None)
+                with self._digests_lock:
+                    self._digests.pop(user_id, None)
+                evicted += 1
+
+        return evicted
+
+    def get_user_data(self) -> LazyUserData:
+        return LazyUserData(UserSession, store=self)
+
+    def get_chat_data(self) -> defaultdict:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> dict:
+        return {}
+
+    def get_conversations(self, name: str) -> dict:
+        return {}
+
+    def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    def update_user_data(self, user_id: int, data) -> None:
+        # Only tracked here, not refreshed: the dispatcher saves every loaded user after each job,
+        # e.g. the eviction job itself, which says nothing about the user being active
+        self._last_seen.setdefault(user_id, time.monotonic())
+        raw = self.serialize(data)
+        digest = hashlib.blake2b(raw, digest_size=16).digest()
+
+        with self._digests_lock:
+            if self._digests.get(user_id) == digest:
+                return
+
+        self._shard_of(user_id).save(user_id, raw)
+
+        with self._digests_lock:
+            self._digests[user_id] = digest
+
+    def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    def update_bot_data(self, data) -> None:
+        pass
+
+    def flush(self) -> None:
+        # Every write is committed right away. The updater calls this on SIGTERM, while the
+        # scheduled handlers may still be saving, so the connections stay open until `close`
+        for shard in self._shards:
+            shard.checkpoint()
+
+    def close(self) -> None:
+        """Close the shard files, after the last update has been saved"""
+        for shard in self._shards:
+            shard.close()
@@ -0,0 +1,194 @@
+import json
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+from utils import metrics
+from utils.aio import run_ffmpeg
+
+PROBE_COMMAND = ["ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json"]
+
+# The codecs the output containers can hold as they are, so a file in any of these codecs can
+# be remuxed instead of encoded
+CONTAINER_CODECS = {
+    'mp4': {'h264', 'hevc', 'mpeg4', 'av1', 'aac', 'mp3', 'alac', 'opus'},
+    'mov': {'h264', 'hevc', 'mpeg4', 'prores', 'aac', 'mp3', 'alac', 'pcm_s16le'},
+    'mkv': None,
+    'webm': {'vp8', 'vp9', 'av1', 'opus', 'vorbis'},
+    'mp3': {'mp3'},
+    'ogg': {'opus', 'vorbis', 'flac'},
+}
+
+
+class MediaInfo(NamedTuple):
+    """What ffprobe reports about a media file: the container and its first video and audio
+    streams. The fields of a missing stream are empty."""
+
+    container: str
+    duration: float
+    bit_rate: int
+    size: int
+    video_streams: int
+    audio_streams: int
+    video_codec: str = ''
+    pix_fmt: str = ''
+    width: int = 0
+    height: int = 0
+    frame_rate: float = 0.0
+    video_bit_rate: int = 0
+    audio_codec: str = ''
+    audio_bit_rate: int = 0
+    sample_rate: int = 0
+    channels: int = 0
+    channel_layout: str = ''
+
+    def can_copy_to(self, container: str) -> bool:
+        """Whether the streams fit `container` as they are, e.g. 'mp4' or 'webm'"""
+        if container not in CONTAINER_CODECS:
+            return False
+        codecs = CONTAINER_CODECS[container]
+        if codecs is None:
+            return True
+
+        return all(codec in codecs for codec in (self.video_codec, self.audio_codec) if codec)
+
+
+def _int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _frame_rate(value) -> float:
+    # ffprobe reports it as a fraction, e.g. '30000/1001'
+    numerator, _slash, denominator = (value or '').partition('/')
+    if _float(denominator or 1) == 0:
+        return 0.0
+
+    return _float(numerator) / _float(denominator or 1)
+
+
+def parse_probe(output) -> MediaInfo:
+    """Build a `MediaInfo` out of the JSON output of ffprobe
+
+    **Keyword arguments:**
+     - output (bytes) -- What `ffprobe -show_format -show_streams -of json` printed
+
+    **Returns:**
+     The parsed `MediaInfo`
+    """
+    probe = json.loads(output)
+    media_format = probe.get('format', {})
+    streams = probe.get('streams', [])
+    videos = [stream for stream in streams if stream.get('codec_type') == 'video'
+              and not stream.get('disposition', {}).get('attached_pic')]
+    audios = [stream for stream in streams if stream.get('codec_type') == 'audio']
+    video = videos[0] if videos else {}
+    audio = audios[0] if audios else {}
+
+    return MediaInfo(
+        container=media_format.get('format_name', ''),
+        duration=_float(media_format.get('duration')),
+        bit_rate=_int(media_format.get('bit_rate')),
+        size=_int(media_format.get('size')),
+        video_streams=len(videos),
+        audio_streams=len(audios),
+        video_codec=video.get('codec_name', ''),
+        pix_fmt=video.get('pix_fmt', ''),
+        width=_int(video.get('width')),
+        height=_int(video.get('height')),
+        frame_rate=_frame_rate(video.get('avg_frame_rate')) or _frame_rate(video.get('r_frame_rate')),
+        video_bit_rate=_int(video.get('bit_rate')),
+        audio_codec=audio.get('codec_name', ''),
+        audio_bit_rate=_int(audio.get('bit_rate')),
+        sample_rate=_int(audio.get('sample_rate')),
+        channels=_int(audio.get('channels')),
+        channel_layout=audio.get('channel_layout', ''),
+    )
+
+
+def probe_file(path: str) -> MediaInfo:
+    """Probe a file synchronously and without caching, for the code that doesn't run on the
+    event loop
+
+    **Keyword arguments:**
+     - path (str) -- The path of the file
+
+    **Returns:**
+     The `MediaInfo` of the file
+
+    **Raises:**
+     subprocess.CalledProcessError if ffprobe can't read the file
+    """
+    with metrics.phase('ffmpeg'):
+        result = subprocess.run(PROBE_COMMAND + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+    return parse_probe(result.stdout)
+
+
+class MediaProber:
+    """Runs ffprobe on the downloaded files and remembers the results by the Telegram
+    `file_unique_id` of the file, so every conversion of the same file after the first one
+    knows what it is working with for free.
+
+    **Keyword arguments:**
+     - max_size (int) -- How many results to keep, the least recently used ones go first
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+
+    def get(self, file_unique_id: str):
+        with self._lock:
+            info = self._results.get(file_unique_id)
+            if info is not None:
+                self._results.move_to_end(file_unique_id)
+
+        return info
+
+    def put(self, file_unique_id: str, info: MediaInfo) -> None:
+        with self._lock:
+            self._results[file_unique_id] = info
+            self._results.move_to_end(file_unique_id)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    async def probe(self, path: str, file_unique_id: str = None) -> MediaInfo:
+        """Probe a file, or return the result of a previous probe of the same file
+
+        **Keyword arguments:**
+         - path (str) -- The path of the file
+         - file_unique_id (str) -- The `file_unique_id` of the file, nothing is cached without it
+
+        **Returns:**
+         The `MediaInfo` of the file
+
+        **Raises:**
+         subprocess.CalledProcessError if ffprobe can't read the file
+        """
+        if file_unique_id:
+            info = self.get(file_unique_id)
+            if info is not None:
+                return info
+
+        info = parse_probe(await run_ffmpeg(PROBE_COMMAND + [path]))
+        if file_unique_id:
+            self.put(file_unique_id, info)
+
+        return info
+
+
+prober = MediaProber(max_size=int(os.getenv("PROBE_CACHE_SIZE") or 10000))
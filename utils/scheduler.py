@@ -0,0 +1,137 @@
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger()
+
+
+class SchedulerFull(Exception):
+    """Raised when a user already has too many tasks waiting"""
+
+
+class UserScheduler:
+    """Runs tasks on a pool of worker threads, one task of a user at a time.
+
+    Tasks of the same user run in the order they were submitted and never overlap, so two
+    updates of a user can't race on their `user_data`, while the tasks of different users run in
+    parallel. Users take turns: after one of their tasks has run, a user goes to the back of the
+    line.
+
+    **Keyword arguments:**
+     - workers (int) -- How many tasks may run at the same time
+     - max_pending (int) -- How many tasks may wait in total. `submit` blocks while it is
+       reached, which makes the dispatcher stop taking new updates
+     - max_pending_per_user (int) -- How many tasks a single user may have waiting
+    """
+
+    def __init__(self, workers: int, max_pending: int, max_pending_per_user: int) -> None:
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.max_pending_per_user = max(1, max_pending_per_user)
+
+        self._condition = threading.Condition()
+        self._queues = {}
+        self._ready = deque()
+        self._active = set()
+        self._pending = 0
+        self._threads = []
+        self._stopping = False
+
+    def start(self) -> None:
+        """Start the worker threads. Calling it more than once has no effect."""
+        with self._condition:
+            if self._threads:
+                return
+            self._stopping = False
+            self._threads = [
+                threading.Thread(target=self._work, name=f"scheduler-{index}", daemon=True)
+                for index in range(self.workers)
+            ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, wait: bool = True) -> None:
+        """Stop the worker threads once the queued tasks are done
+
+        **Keyword arguments:**
+         - wait (bool) -- Whether to wait for the worker threads to finish
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            threads, self._threads = self._threads, []
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def submit(self, user_id: int, task, limit: bool = True) -> None:
+        """Queue a task for the given user.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user the task belongs to
+         - task (callable) -- A function without arguments
+         - limit (bool) -- Whether the limits apply. Tasks that finish work which has already
+           been accepted, such as sending a conversion result, shouldn't be rejected
+
+        **Raises:**
+         SchedulerFull if the user already has `max_pending_per_user` tasks waiting
+        """
+        with self._condition:
+            if limit:
+                queue = self._queues.get(user_id)
+                if queue is not None and len(queue) >= self.max_pending_per_user:
+                    raise SchedulerFull(f"User {user_id} has too many pending updates")
+                while self._pending >= self.max_pending and not self._stopping:
+                    self._condition.wait()
+
+            queue = self._queues.setdefault(user_id, deque())
+            queue.append(task)
+            self._pending += 1
+            if len(queue) == 1 and user_id not in self._active:
+                self._ready.append(user_id)
+            self._condition.notify_all()
+
+    def has_pending(self, user_id: int) -> bool:
+        """Whether the user has any task waiting or running"""
+        with self._condition:
+            return user_id in self._queues or user_id in self._active
+
+    def pending(self) -> int:
+        """The number of tasks waiting to be run"""
+        with self._condition:
+            return self._pending
+
+    def _next_task(self):
+        with self._condition:
+            while not self._ready:
+                if self._stopping and not self._pending:
+                    return None, None
+                self._condition.wait()
+
+            user_id = self._ready.popleft()
+            queue = self._queues[user_id]
+            task = queue.popleft()
+            if not queue:
+                del self._queues[user_id]
+            self._active.add(user_id)
+            self._pending -= 1
+            self._condition.notify_all()
+
+            return user_id, task
+
+    def _work(self) -> None:
+        while True:
+            user_id, task = self._next_task()
+            if task is None:
+                return
+
+            try:
+                task()
+            except BaseException:
+                logger.error("Task of user %s failed", user_id, exc_info=True)
+            finally:
+                with self._condition:
+                    self._active.discard(user_id)
+                    if user_id in self._queues:
+                        self._ready.append(user_id)
+                    self._condition.notify_all()
@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import threading
+
+from cachetools import LRUCache
+from orator.exceptions.query import QueryException
+
+from models.sent_file import SentFile
+from utils import metrics
+from utils.cache import transcode_params_key
+
+logger = logging.getLogger()
+
+_lock = threading.Lock()
+_file_ids = LRUCache(maxsize=10000)
+
+
+def _params_hash(params: dict) -> str:
+    return hashlib.sha256(transcode_params_key(params).encode('utf-8')).hexdigest()
+
+
+def find_sent_file_id(source_unique_id: str, operation: str, params: dict):
+    """Find the Telegram `file_id` of a result that has already been uploaded once.
+
+    **Keyword arguments:**
+     - source_unique_id (str) -- The `file_unique_id` of the file the user sent
+     - operation (str) -- The name of the operation, e.g. 'voice_to_mp3'
+     - params (dict) -- The parameters of the operation
+
+    **Returns:**
+     The `file_id` of the uploaded result or `None`
+    """
+    if not source_unique_id:
+        return None
+
+    params_hash = _params_hash(params)
+    key = (source_unique_id, operation, params_hash)
+
+    with _lock:
+        if key in _file_ids:
+            return _file_ids[key]
+
+    with metrics.phase('db'):
+        sent_file = SentFile.where('source_unique_id', '=', source_unique_id) \
+            .where('operation', '=', operation) \
+            .where('params_hash', '=', params_hash) \
+            .first()
+
+    if not sent_file:
+        return None
+
+    with _lock:
+        _file_ids[key] = sent_file.file_id
+
+    return sent_file.file_id
+
+
+def remember_sent_file_id(source_unique_id: str, operation: str, params: dict, file_id: str) -> None:
+    """Store the Telegram `file_id` of an uploaded result so it can be sent again by id. Other
+    workers may store the same result at the same time, so the row is updated if it exists.
+
+    **Keyword arguments:**
+     - source_unique_id (str) -- The `file_unique_id` of the file the user sent
+     - operation (str) -- The name of the operation, e.g. 'voice_to_mp3'
+     - params (dict) -- The parameters of the operation
+     - file_id (str) -- The `file_id` Telegram returned for the uploaded result
+    """
+    if not source_unique_id or not file_id:
+        return
+
+    params_hash = _params_hash(params)
+
+    with _lock:
+        _file_ids[(source_unique_id, operation, params_hash)] = file_id
+
+    def update() -> int:
+        return SentFile.where('source_unique_id', '=', source_unique_id) \
+            .where('operation', '=', operation) \
+            .where('params_hash', '=', params_hash) \
+            .update(file_id=file_id)
+
+    with metrics.phase('db'):
+        # MySQL counts only the changed rows, so 0 may also mean the same file_id is stored
+        if update():
+            return
+
+        try:
+            SentFile.create(
+                source_unique_id=source_unique_id,
+                operation=operation,
+                params_hash=params_hash,
+                file_id=file_id
+            )
+        except QueryException:
+            # The unique key is taken, by an earlier or a concurrent upload
+            update()
+
+
+def forget_sent_file_id(source_unique_id: str, operation: str, params: dict) -> None:
+    """Drop a stored `file_id`, e.g. because Telegram doesn't accept it anymore.
+
+    **Keyword arguments:**
+     - source_unique_id (str) -- The `file_unique_id` of the file the user sent
+     - operation (str) -- The name of the operation, e.g. 'voice_to_mp3'
+     - params (dict) -- The parameters of the operation
+    """
+    params_hash = _params_hash(params)
+
+    with _lock:
+        _file_ids.pop((source_unique_id, operation, params_hash), None)
+
+    with metrics.phase('db'):
+        SentFile.where('source_unique_id', '=', source_unique_id) \
+            .where('operation', '=', operation) \
+            .where('params_hash', '=', params_hash) \
+            .delete()
@@ -0,0 +1,181 @@
+import json
+
+# The fields of a session and the values they have until they are set. The position of a field
+# is its id in the serialized form, so new fields must only ever be appended to this list.
+SESSION_FIELDS = (
+    ('language', 'en'),
+    ('current_active_module', ''),
+    ('tag_editor', dict),
+    ('music_path', ''),
+    ('music_unique_id', ''),
+    ('music_duration', 0),
+    ('music_message_id', 0),
+    ('art_path', ''),
+    ('new_art_path', ''),
+    ('voice_path', ''),
+    ('voice_unique_id', ''),
+    ('voice_file_id', ''),
+    ('voice_message_id', 0),
+    ('voice_duration', 0),
+    ('voice_art_path', ''),
+    ('new_voice_art_path', ''),
+    ('video_path', ''),
+    ('video_unique_id', ''),
+    ('video_message_id', ''),
+    ('video_duration', ''),
+    ('video_art_path', ''),
+    ('new_video_art_path', ''),
+    ('convert_video_to_gif', False),
+    ('convert_video_to_circle', False),
+    ('gif', ''),
+    ('trace_id', ''),
+    ('video_width', 0),
+    ('video_height', 0),
+    ('video_note_path', ''),
+    ('video_file_id', ''),
+)
+
+_DEFAULTS = dict(SESSION_FIELDS)
+_FIELD_IDS = {name: field_id for field_id, (name, _default) in enumerate(SESSION_FIELDS)}
+
+
+class UserSession:
+    """The `user_data` of a user.
+
+    It behaves like the dictionary `user_data` used to be (`session['voice_path']`,
+    `'gif' in session`, ...), but only the fields that have been set take up memory, and
+    unset fields read as their default value. A user who has only picked a language carries a
+    single field around instead of a full dictionary of empty paths.
+    """
+
+    __slots__ = tuple(name for name, _default in SESSION_FIELDS)
+
+    def __getattr__(self, name: str):
+        # Only called for fields that haven't been set
+        if name not in _DEFAULTS:
+            raise AttributeError(name)
+        default = _DEFAULTS[name]
+        if callable(default):
+            default = default()
+            object.__setattr__(self, name, default)
+
+        return default
+
+    def __getitem__(self, key: str):
+        if key not in _DEFAULTS:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value) -> None:
+        if key not in _DEFAULTS:
+            raise KeyError(f"Unknown session field: {key}")
+        setattr(self, key, value)
+
+    def __delitem__(self, key: str) -> None:
+        try:
+            delattr(self, key)
+        except AttributeError as error:
+            raise KeyError(key) from error
+
+    def __contains__(self, key: str) -> bool:
+        return key in _DEFAULTS and self._is_set(key)
+
+    def __len__(self) -> int:
+        return sum(1 for name in self.__slots__ if self._is_set(name))
+
+    def __iter__(self):
+        return (name for name in self.__slots__ if self._is_set(name))
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, UserSession):
+            return NotImplemented
+
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self) -> str:
+        return f"UserSession({dict(self.items())!r})"
+
+    def __copy__(self) -> 'UserSession':
+        session = UserSession()
+        session.update(self.items())
+
+        return session
+
+    def _is_set(self, name: str) -> bool:
+        try:
+            object.__getattribute__(self, name)
+        except AttributeError:
+            return False
+
+        return True
+
+    def get(self, key: str, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(name, object.__getattribute__(self, name)) for name in self]
+
+    def update(self, values=(), **kwargs) -> None:
+        if hasattr(values, 'items'):
+            values = values.items()
+        for key, value in values:
+            self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def clear(self) -> None:
+        for name in list(self):
+            delattr(self, name)
+
+    def to_bytes(self) -> bytes:
+        """Serialize the fields that differ from their default as `[field_id, value, ...]`
+
+        **Returns:**
+         The serialized session
+        """
+        payload = []
+        for name, value in self.items():
+            default = _DEFAULTS[name]
+            if value == (default() if callable(default) else default):
+                continue
+            payload.append(_FIELD_IDS[name])
+            payload.append(value)
+
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> 'UserSession':
+        """Build a session back from the output of `to_bytes`
+
+        **Keyword arguments:**
+         - raw (bytes) -- The serialized session
+
+        **Returns:**
+         UserSession instance
+        """
+        session = cls()
+        payload = json.loads(raw.decode('utf-8'))
+        for index in range(0, len(payload), 2):
+            name = SESSION_FIELDS[payload[index]][0]
+            setattr(session, name, payload[index + 1])
+
+        return session
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'UserSession':
+        """Build a session out of an old dictionary style `user_data`, ignoring unknown keys
+
+        **Keyword arguments:**
+         - data (dict) -- The `user_data` dictionary
+
+        **Returns:**
+         UserSession instance
+        """
+        session = cls()
+        session.update((key, value) for key, value in data.items() if key in _DEFAULTS)
+
+        return session
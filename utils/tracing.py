@@ -0,0 +1,154 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_exporter = None
+
+
+class Span:
+    """A timed step of handling a user request, e.g. the download or the ffmpeg run.
+
+    Spans of the same request share a `trace_id`; `parent_id` links a span to the step it is a
+    part of. Attributes hold whatever helps to explain the duration: file size, codec, ...
+    """
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'started_at', '_start')
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: dict = None) -> None:
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self, duration: float) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.started_at,
+            'duration_ms': round(duration * 1000, 3),
+            'thread': threading.current_thread().name,
+            'attributes': self.attributes,
+        }
+
+
+class _NoopSpan:
+    """What `span` yields when tracing is off, so the call sites don't have to check"""
+
+    __slots__ = ()
+
+    trace_id = None
+    span_id = None
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class JSONLinesExporter:
+    """Appends every finished span to a file as one JSON object per line. Each line is written
+    with a single `write` to a file opened in append mode, so the worker processes can share
+    the file.
+
+    **Keyword arguments:**
+     - path (str) -- The file to append the spans to
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def export(self, span: dict) -> None:
+        line = json.dumps(span, ensure_ascii=False, default=str, separators=(',', ':')) + "\n"
+        try:
+            os.write(self._descriptor, line.encode('utf-8'))
+        except OSError:
+            logger.error("Couldn't export the span %s", span['name'], exc_info=True)
+
+    def close(self) -> None:
+        os.close(self._descriptor)
+
+
+def configure(path: str) -> None:
+    """Turn tracing on and export the spans to `path`. Tracing stays off if it is empty.
+
+    **Keyword arguments:**
+     - path (str) -- The JSON lines file to append the spans to
+    """
+    global _exporter
+
+    if _exporter is not None:
+        _exporter.close()
+        _exporter = None
+    if path:
+        _exporter = JSONLinesExporter(path)
+
+
+def enabled() -> bool:
+    return _exporter is not None
+
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+
+def current_span():
+    """The innermost open span of the current thread or asyncio task, if any"""
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, parent=None, trace_id: str = None, **attributes):
+    """Time the body of the `with` block as a span.
+
+    The parent defaults to the innermost open span of the current thread or task. Work handed
+    over to another thread (the scheduler, the transcoder callbacks) has to pass the span it
+    belongs to as `parent` explicitly. `asyncio.to_thread` carries it over on its own.
+
+    **Keyword arguments:**
+     - name (str) -- The name of the span
+     - parent (Span) -- The span this one is a part of
+     - trace_id (str) -- The trace to start the span in when there is no parent
+     - attributes -- Attributes to attach to the span
+
+    **Returns:**
+     A context manager yielding the span
+    """
+    if _exporter is None:
+        yield _NOOP_SPAN
+        return
+
+    if parent is None:
+        parent = _current_span.get()
+    if isinstance(parent, Span):
+        new_span = Span(name, parent.trace_id, parent.span_id, attributes)
+    else:
+        new_span = Span(name, trace_id or new_trace_id(), None, attributes)
+
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as error:
+        new_span.set(error=type(error).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        exporter = _exporter
+        if exporter is not None:
+            exporter.export(new_span.to_dict(time.perf_counter() - new_span._start))
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from utils.aio import AsyncRuntime
+
+logger = logging.getLogger()
+
+
+class TranscodeQueueFull(Exception):
+    """Raised when a job can't be queued because the executor (or the user's own queue) is full"""
+
+
+class TranscodeExecutor:
+    """Runs conversion jobs on an `AsyncRuntime` instead of on the dispatcher thread.
+
+    Jobs are queued per user and started in round-robin order of users, so a user who sends
+    ten videos in a row doesn't delay everybody else's single voice message. A job is either a
+    coroutine function, which is awaited on the event loop, or a plain function, which runs on
+    the loop's thread pool. The callbacks usually upload the result, so they run on the thread
+    pool too.
+
+    **Keyword arguments:**
+     - runtime (AsyncRuntime) -- The event loop to run the jobs on
+     - max_in_flight (int) -- How many jobs may be in progress at the same time
+     - max_queue_depth (int) -- How many jobs may wait in total before new ones are rejected
+     - max_jobs_per_user (int) -- How many jobs a single user may have waiting or running
+    """
+
+    def __init__(self, runtime: AsyncRuntime, max_in_flight: int, max_queue_depth: int,
+                 max_jobs_per_user: int) -> None:
+        self.runtime = runtime
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue_depth = max(1, max_queue_depth)
+        self.max_jobs_per_user = max(1, max_jobs_per_user)
+
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()
+        self._jobs_per_user = {}
+        self._queued = 0
+        self._running = 0
+        self._started = False
+        self._stopped = False
+
+    def start(self) -> None:
+        """Start running the queued jobs. Calling it more than once has no effect."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self._stopped = False
+        self.runtime.start()
+        self._pump()
+
+    def stop(self) -> None:
+        """Stop accepting jobs. The runtime should be stopped afterwards to wait for the running ones."""
+        with self._lock:
+            self._stopped = True
+
+    def submit(self, user_id: int, job, on_done=None, on_error=None) -> None:
+        """Queue a job for the given user.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user the job belongs to
+         - job (callable) -- A coroutine function or a function without arguments that does
+           the actual work
+         - on_done (callable) -- Called with the result of `job` when it succeeds
+         - on_error (callable) -- Called with the raised exception when `job` fails
+
+        **Raises:**
+         TranscodeQueueFull if the executor or the user's own queue is full
+        """
+        with self._lock:
+            if self._stopped:
+                raise TranscodeQueueFull("Transcoder has been stopped")
+            if self._queued >= self.max_queue_depth:
+                raise TranscodeQueueFull("Transcode queue is full")
+            if self._jobs_per_user.get(user_id, 0) >= self.max_jobs_per_user:
+                raise TranscodeQueueFull(f"User {user_id} has too many pending jobs")
+
+            self._queues.setdefault(user_id, deque()).append((job, on_done, on_error))
+            self._jobs_per_user[user_id] = self._jobs_per_user.get(user_id, 0) + 1
+            self._queued += 1
+
+        self._pump()
+
+    def has_pending(self, user_id: int) -> bool:
+        """Whether the user has any job waiting or running"""
+        with self._lock:
+            return self._jobs_per_user.get(user_id, 0) > 0
+
+    def queue_depth(self) -> int:
+        """The number of jobs waiting to be started"""
+        with self._lock:
+            return self._queued
+
+    def running(self) -> int:
+        """The number of jobs currently in progress"""
+        with self._lock:
+            return self._running
+
+    def _pump(self) -> None:
+        """Start as many queued jobs as there are free slots, in round-robin order of users"""
+        while True:
+            with self._lock:
+                if not self._started or not self._queues or self._running >= self.max_in_flight:
+                    return
+                user_id, queue = self._queues.popitem(last=False)
+                job = queue.popleft()
+                if queue:
+                    self._queues[user_id] = queue
+                self._queued -= 1
+                self._running += 1
+
+            self.runtime.submit(self._run(user_id, *job))
+
+    async def _run(self, user_id: int, job, on_done, on_error) -> None:
+        try:
+            if asyncio.iscoroutinefunction(job):
+                result = await job()
+            else:
+                result = await asyncio.to_thread(job)
+        except BaseException as error:
+            logger.error("Transcode job of user %s failed", user_id, exc_info=True)
+            await self._call(on_error, error)
+        else:
+            await self._call(on_done, result)
+        finally:
+            with self._lock:
+                self._running -= 1
+                remaining = self._jobs_per_user[user_id] - 1
+                if remaining:
+                    self._jobs_per_user[user_id] = remaining
+                else:
+                    del self._jobs_per_user[user_id]
+            self._pump()
+
+    @staticmethod
+    async def _call(callback, argument) -> None:
+        if callback is None:
+            return
+        try:
+            await asyncio.to_thread(callback, argument)
+        except BaseException:
+            logger.error("Transcode callback failed", exc_info=True)
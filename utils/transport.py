@@ -0,0 +1,81 @@
+from telegram import InputFile
+from telegram.utils.request import Request
+
+from utils import metrics, tracing
+
+
+def is_upload(data: dict) -> bool:
+    """Whether a Bot API call uploads a file, as opposed to a small JSON call
+
+    **Keyword arguments:**
+     - data (dict) -- The parameters of the call
+
+    **Returns:**
+     `True` if one of the parameters is a file to upload
+    """
+    for key, value in (data or {}).items():
+        if isinstance(value, InputFile):
+            return True
+        if key == 'media':
+            media = value if isinstance(value, list) else [value]
+            if any(isinstance(getattr(item, 'media', None), InputFile) for item in media):
+                return True
+
+    return False
+
+
+class SplitRequest(Request):
+    """The HTTP transport of the bot, with one connection pool for small JSON calls and another
+    one for uploads and downloads.
+
+    With a single pool a 50 MB upload holds on to a connection for as long as it takes, and
+    once every connection is busy the next `reply_text` has to wait for one or open a new
+    connection from scratch. With two pools the small calls always find a warm keep-alive
+    connection of their own.
+
+    **Keyword arguments:**
+     - con_pool_size (int) -- How many connections to keep for the JSON calls
+     - transfer_pool_size (int) -- How many connections to keep for uploads and downloads
+     - connect_timeout (float) -- The timeout of opening a connection
+     - read_timeout (float) -- The read timeout of the JSON calls that don't set their own
+     - transfer_read_timeout (float) -- The shortest read timeout of the uploads and downloads.
+       The `send_*` methods of the bot pass 20 seconds by default, which is too short for a
+       big file, so a shorter timeout is raised to this one.
+    """
+
+    __slots__ = ('transfers', 'transfer_read_timeout')
+
+    def __init__(self, con_pool_size: int, transfer_pool_size: int, connect_timeout: float = 5.0,
+                 read_timeout: float = 5.0, transfer_read_timeout: float = 120.0, **kwargs) -> None:
+        super().__init__(
+            con_pool_size=con_pool_size,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            **kwargs
+        )
+        self.transfers = Request(
+            con_pool_size=transfer_pool_size,
+            connect_timeout=connect_timeout,
+            read_timeout=transfer_read_timeout,
+            **kwargs
+        )
+        self.transfer_read_timeout = transfer_read_timeout
+
+    def _transfer_timeout(self, timeout: float = None) -> float:
+        return max(timeout or 0, self.transfer_read_timeout)
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        if is_upload(data):
+            with metrics.phase('upload'), tracing.span('upload', method=url.rsplit('/', 1)[-1]):
+                return self.transfers.post(url, data, timeout=self._transfer_timeout(timeout))
+
+        with metrics.phase('api_call'):
+            return super().post(url, data, timeout=timeout)
+
+    def retrieve(self, url: str, timeout: float = None) -> bytes:
+        # `download` goes through here as well
+        return self.transfers.retrieve(url, timeout=self._transfer_timeout(timeout))
+
+    def stop(self) -> None:
+        super().stop()
+        self.transfers.stop()
@@ -0,0 +1,125 @@
+import logging
+import threading
+
+from dbConfig import db
+from utils import metrics
+
+logger = logging.getLogger()
+
+# How many users to update with a single statement
+MAX_USERS_PER_UPDATE = 500
+
+
+def build_files_sent_increment(increments: dict) -> str:
+    """Build the SQL expression that adds each user's pending increments to the counter in a
+    single UPDATE, e.g. `number_of_files_sent + CASE user_id WHEN 1 THEN 3 ... ELSE 0 END`
+
+    **Keyword arguments:**
+     - increments (dict) -- A mapping of user ids to the amount to add
+
+    **Returns:**
+     The SQL expression
+    """
+    cases = ' '.join(
+        f"WHEN {int(user_id)} THEN {int(amount)}"
+        for user_id, amount in increments.items()
+    )
+
+    return f"number_of_files_sent + CASE user_id {cases} ELSE 0 END"
+
+
+class UsageCounter:
+    """Aggregates the increments of `users.number_of_files_sent` in memory and writes them with
+    one `UPDATE ... SET number_of_files_sent = number_of_files_sent + CASE ...` per batch.
+
+    The addition happens in the database, so the counts stay correct when several processes
+    increment the same user. A flush happens every `flush_interval` seconds or as soon as
+    `flush_threshold` increments are pending, whichever comes first.
+
+    **Keyword arguments:**
+     - flush_interval (float) -- How many seconds to wait between two flushes
+     - flush_threshold (int) -- How many pending increments trigger an early flush
+    """
+
+    def __init__(self, flush_interval: float, flush_threshold: int) -> None:
+        self.flush_interval = flush_interval
+        self.flush_threshold = max(1, flush_threshold)
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._increments = {}
+        self._pending_total = 0
+        self._wake_event = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher = None
+
+    def start(self) -> None:
+        """Start the background flusher thread"""
+        if self._flusher is not None:
+            return
+        self._stopped.clear()
+        self._flusher = threading.Thread(target=self._run_flusher, name='usage-counter-flusher', daemon=True)
+        self._flusher.start()
+
+    def stop(self) -> None:
+        """Stop the flusher thread and write the pending increments"""
+        self._stopped.set()
+        self._wake_event.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def increment(self, user_id: int, amount: int = 1) -> None:
+        """Add to the counter of a user on the next flush.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+         - amount (int) -- How much to add
+        """
+        with self._lock:
+            self._increments[user_id] = self._increments.get(user_id, 0) + amount
+            self._pending_total += amount
+            if self._pending_total >= self.flush_threshold:
+                self._wake_event.set()
+
+    def pending(self, user_id: int) -> int:
+        """The increments of a user that haven't been written yet"""
+        with self._lock:
+            return self._increments.get(user_id, 0)
+
+    def flush(self) -> None:
+        """Write all the pending increments to the database"""
+        with self._flush_lock:
+            with self._lock:
+                increments = self._increments
+                self._increments = {}
+                self._pending_total = 0
+
+            if not increments:
+                return
+
+            try:
+                self._write(increments)
+            except BaseException:
+                logger.error("Couldn't flush the usage counters of %s users", len(increments), exc_info=True)
+                with self._lock:
+                    for user_id, amount in increments.items():
+                        self._increments[user_id] = self._increments.get(user_id, 0) + amount
+                        self._pending_total += amount
+
+    def _write(self, increments: dict) -> None:
+        user_ids = list(increments)
+
+        with metrics.phase('db'), db.transaction():
+            for start in range(0, len(user_ids), MAX_USERS_PER_UPDATE):
+                batch = {user_id: increments[user_id] for user_id in user_ids[start:start + MAX_USERS_PER_UPDATE]}
+                db.table('users') \
+                    .where_in('user_id', list(batch)) \
+                    .update(number_of_files_sent=db.raw(build_files_sent_increment(batch)))
+
+    def _run_flusher(self) -> None:
+        while not self._stopped.is_set():
+            self._wake_event.wait(self.flush_interval)
+            self._wake_event.clear()
+            self.flush()
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from dbConfig import db
+from models.user import User
+from utils import metrics
+from utils.usage_counter import UsageCounter
+
+logger = logging.getLogger()
+
+USER_COLUMNS = ('username', 'language', 'number_of_files_sent')
+
+
+class _CachedUser:
+    __slots__ = ('values', 'dirty', 'loaded_at')
+
+    def __init__(self, values: dict) -> None:
+        self.values = values
+        self.dirty = {}
+        self.loaded_at = time.monotonic()
+
+    def is_dirty(self) -> bool:
+        return bool(self.dirty)
+
+
+class UserCache:
+    """An in-process cache of the rows of the `users` table with write-behind.
+
+    Reads are answered from memory for `ttl` seconds. Changes to the username and the language
+    are only applied to the cached row and a background thread writes them to the database
+    every `flush_interval` seconds, so a burst of messages from a user costs a single UPDATE
+    instead of a SELECT and an UPDATE per message. Usage counter increments are handed over to
+    a `UsageCounter`, which batches them for all users.
+
+    **Keyword arguments:**
+     - ttl (float) -- How many seconds a row read from the database stays valid
+     - max_size (int) -- How many rows to keep; the least recently used clean rows go first
+     - flush_interval (float) -- How many seconds to wait between two flushes
+     - usage_counter (UsageCounter) -- Where to send the usage counter increments
+    """
+
+    def __init__(self, ttl: float, max_size: int, flush_interval: float, usage_counter: UsageCounter) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.usage_counter = usage_counter
+
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._users = OrderedDict()
+        self._stop_event = threading.Event()
+        self._flusher = None
+
+    def start(self) -> None:
+        """Start the background flusher thread"""
+        if self._flusher is not None:
+            return
+        self._stop_event.clear()
+        self._flusher = threading.Thread(target=self._run_flusher, name='user-cache-flusher', daemon=True)
+        self._flusher.start()
+
+    def stop(self) -> None:
+        """Stop the flusher thread and write the pending changes"""
+        self._stop_event.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def get(self, user_id: int):
+        """Find a user, reading it from the database if it isn't cached or has expired.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+
+        **Returns:**
+         A dictionary with the columns of the user or `None` if the user doesn't exist
+        """
+        with self._lock:
+            cached_user = self._users.get(user_id)
+            if cached_user and time.monotonic() - cached_user.loaded_at < self.ttl:
+                self._users.move_to_end(user_id)
+                return self._values_of(cached_user)
+
+        with metrics.phase('db'):
+            user = User.where('user_id', '=', user_id).first()
+        if not user:
+            return None
+
+        with self._lock:
+            cached_user = self._remember(user_id, {column: getattr(user, column) for column in USER_COLUMNS})
+            return self._values_of(cached_user)
+
+    def add(self, user_id: int, values: dict) -> None:
+        """Cache a user that has just been inserted into the database.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+         - values (dict) -- The columns of the user
+        """
+        with self._lock:
+            self._remember(user_id, {column: values.get(column) for column in USER_COLUMNS})
+
+    def update(self, user_id: int, **values) -> None:
+        """Change some columns of a user. The change is written to the database on the next flush.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+         - values -- The columns to change, e.g. `username` or `language`
+        """
+        with self._lock:
+            cached_user = self._cached_or_placeholder(user_id)
+            for column, value in values.items():
+                if cached_user.values.get(column) != value or column in cached_user.dirty:
+                    cached_user.values[column] = value
+                    cached_user.dirty[column] = value
+
+    def increment_files_sent(self, user_id: int) -> None:
+        """Increment the `number_of_files_sent` column of a user on the next flush.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+        """
+        with self._lock:
+            cached_user = self._cached_or_placeholder(user_id)
+            if cached_user.values.get('number_of_files_sent') is not None:
+                cached_user.values['number_of_files_sent'] += 1
+            self.usage_counter.increment(user_id)
+
+    def flush(self) -> None:
+        """Write all the pending changes to the database"""
+        with self._flush_lock:
+            with self._lock:
+                changes = []
+                for user_id, cached_user in self._users.items():
+                    if cached_user.is_dirty():
+                        changes.append((user_id, cached_user.dirty))
+                        cached_user.dirty = {}
+
+            if not changes:
+                return
+
+            try:
+                self._write(changes)
+            except BaseException:
+                logger.error("Couldn't flush %s cached users", len(changes), exc_info=True)
+                self._restore(changes)
+                return
+
+            with self._lock:
+                self._evict()
+
+    def _write(self, changes: list) -> None:
+        with metrics.phase('db'), db.transaction():
+            for user_id, values in changes:
+                User.where('user_id', '=', user_id).update(**values)
+
+    def _restore(self, changes: list) -> None:
+        with self._lock:
+            for user_id, values in changes:
+                cached_user = self._cached_or_placeholder(user_id)
+                cached_user.dirty = {**values, **cached_user.dirty}
+
+    def _run_flusher(self) -> None:
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def _remember(self, user_id: int, values: dict) -> _CachedUser:
+        """Must be called with the lock held"""
+        # Changes that haven't been written yet win over what is in the database
+        if values.get('number_of_files_sent') is not None:
+            values['number_of_files_sent'] += self.usage_counter.pending(user_id)
+
+        cached_user = self._users.get(user_id)
+        if cached_user is None:
+            cached_user = self._users[user_id] = _CachedUser(values)
+        else:
+            cached_user.values = {**values, **cached_user.dirty}
+            cached_user.loaded_at = time.monotonic()
+        self._users.move_to_end(user_id)
+        self._evict()
+
+        return cached_user
+
+    def _cached_or_placeholder(self, user_id: int) -> _CachedUser:
+        """Must be called with the lock held"""
+        cached_user = self._users.get(user_id)
+        if cached_user is None:
+            # Nothing is known about the user yet; an expired entry makes the next `get`
+            # read the row while the pending changes are kept
+            cached_user = self._users[user_id] = _CachedUser({})
+            cached_user.loaded_at = float('-inf')
+            self._evict()
+        self._users.move_to_end(user_id)
+
+        return cached_user
+
+    def _evict(self) -> None:
+        """Drop the least recently used clean users. Must be called with the lock held"""
+        overflow = len(self._users) - self.max_size
+        if overflow <= 0:
+            return
+        for user_id in list(self._users):
+            if overflow <= 0:
+                break
+            if not self._users[user_id].is_dirty():
+                del self._users[user_id]
+                overflow -= 1
+
+    @staticmethod
+    def _values_of(cached_user: _CachedUser) -> dict:
+        return dict(cached_user.values)
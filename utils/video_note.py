@@ -0,0 +1,83 @@
+"""Video to video note (the round video message) conversion.
+
+Telegram only shows a video note as a circle if it is a square H.264 MP4 of at most a minute.
+Phone cameras record H.264 and AAC already, so a video that is square and short enough only
+needs its streams copied into a fresh MP4 with the index up front. Anything else is cropped to
+its center square, scaled and encoded once.
+"""
+from utils.encoders import ENCODER_PRESETS, select_encoder, video_encoder_args
+
+# The parameters of the conversion, also part of the transcode cache and sent files keys
+VIDEO_NOTE_PARAMS = {
+    'format': 'mp4',
+    'codec': 'libx264',
+    'preset': ENCODER_PRESETS['video_note'],
+    'crf': 26,
+    'audio_codec': 'aac',
+    'audio_bitrate': '64k',
+    'max_side': 640,
+    'max_duration': 60,
+    'max_bytes': 20 * 1024 ** 2,
+}
+
+
+def is_video_note_compliant(info, file_size: int, params: dict) -> bool:
+    """Whether a video can be sent as a video note with its streams copied as they are
+
+    **Keyword arguments:**
+     - info (MediaInfo) -- What ffprobe reported about the video
+     - file_size (int) -- The size of the video file
+     - params (dict) -- The parameters of the conversion, like `VIDEO_NOTE_PARAMS`
+
+    **Returns:**
+     `True` if the video only has to be remuxed
+    """
+    return (
+        info.video_streams == 1
+        and info.audio_streams <= 1
+        and info.video_codec == 'h264'
+        and info.pix_fmt == 'yuv420p'
+        and info.audio_codec in ('', params['audio_codec'])
+        and info.width > 0 and info.width == info.height and info.width <= params['max_side']
+        and 0 < info.duration <= params['max_duration']
+        and file_size <= params['max_bytes']
+    )
+
+
+def remux_command(video_path: str, video_note_path: str) -> list:
+    """The ffmpeg command line copying the streams of a compliant video into a video note"""
+    return [
+        "ffmpeg", "-y", "-i", video_path,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-c:v", "copy", "-c:a", "copy",
+        "-movflags", "+faststart",
+        video_note_path
+    ]
+
+
+def video_note_filter(params: dict) -> str:
+    """The ffmpeg filter graph cropping a video to its center square and scaling it down to an
+    even side"""
+    max_side = params['max_side']
+
+    return (
+        "crop='min(iw,ih)':'min(iw,ih)',"
+        f"scale='2*trunc(min({max_side},iw)/2)':'2*trunc(min({max_side},iw)/2)':flags=lanczos,"
+        "setsar=1"
+    )
+
+
+def encode_command(video_path: str, video_note_path: str, params: dict) -> list:
+    """The ffmpeg command line converting any video into a video note"""
+    return [
+        "ffmpeg", "-y",
+        "-t", str(params['max_duration']), "-i", video_path,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-vf", video_note_filter(params),
+        *video_encoder_args(params),
+        "-pix_fmt", "yuv420p",
+        "-c:a", select_encoder(params['audio_codec']),
+        "-b:a", params['audio_bitrate'],
+        "-movflags", "+faststart",
+        video_note_path
+    ]